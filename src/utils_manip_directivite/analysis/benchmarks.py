@@ -0,0 +1,234 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+import numpy as np
+import pandas as pd
+from scipy.spatial.transform import Rotation
+from scipy.stats import zscore
+from utils_manip_directivite import database
+from utils_manip_directivite.analysis import db_maintenance, extract_data, head_tracking
+from utils_manip_directivite.analysis import movement_analysis as ma
+
+
+def _remove_db(db_path: str) -> None:
+    """Close the cached connections to a synthetic database and remove it, with its WAL files."""
+    database.close(db_path)
+    for path in [db_path, db_path + '-wal', db_path + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_dataframe_rowwise(z_score: bool, db_path: str) -> pd.DataFrame:
+    """Row by row reference implementation of extract_data.get_dataframe."""
+    ratings = []
+    with closing(sqlite3.connect(db_path)) as connection:
+        for rating in extract_data.gather_ratings(connection.cursor()):
+            ratings.append(list(rating))
+
+    df = pd.DataFrame(ratings, columns = extract_data.RATINGS_COLUMNS)
+    df['stimulus'] = df.apply(extract_data.stimulus_col, axis = 1)
+    df = df[['user', 'room', 'distance', 'angle', 'stimulus', 'source', 'repetition', 'answer_timbre', 'answer_plausibility', 'answer_angle', 'answer_movement']]
+    df = df.groupby(['user', 'room', 'distance', 'angle', 'stimulus', 'source'], as_index = False)[['answer_timbre', 'answer_plausibility', 'answer_angle', 'answer_movement']].mean()
+
+    if z_score:
+        for rating in ['answer_plausibility', 'answer_timbre']:
+            df[rating] = df.groupby('user')[rating].transform(lambda x: zscore(x, ddof = 1))
+    return df
+
+
+def _timed(function, *args, **kwargs) -> tuple:
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_get_dataframe(n_ratings: int = 10 ** 6, n_recordings: int = 192, seed: int = 0) -> dict:
+    """
+    Row-wise and vectorized get_dataframe on a synthetic database of about
+    n_ratings ratings, with their time and the largest difference between
+    the two frames.
+    """
+    n_users = -(-n_ratings // n_recordings) + 1
+    db_path = extract_data.create_synthetic_db(n_users = n_users, n_recordings = n_recordings, seed = seed)
+    try:
+        rowwise, rowwise_time = _timed(get_dataframe_rowwise, True, db_path)
+        vectorized, vectorized_time = _timed(extract_data.get_dataframe, True, db_path)
+    finally:
+        _remove_db(db_path)
+
+    numeric = extract_data.ANSWER_COLUMNS
+    same_keys = bool(np.all(rowwise.drop(columns = numeric).astype(object).to_numpy() == vectorized.drop(columns = numeric).astype(object).to_numpy()))
+    return {
+        'ratings': (n_users - 1) * n_recordings,
+        'rows': len(vectorized),
+        'rowwise_s': rowwise_time,
+        'vectorized_s': vectorized_time,
+        'speedup': rowwise_time / vectorized_time,
+        'same_keys': same_keys,
+        'max_abs_diff': float(np.nanmax(np.abs(rowwise[numeric].to_numpy(dtype = float) - vectorized[numeric].to_numpy()), initial = 0.)),
+    }
+
+
+def _query_times(cursor: sqlite3.Cursor, repeats: int) -> dict:
+    """Best time of each project query fetched in full, and of the gather_ratings join alone (aggregated in SQLite)."""
+    queries = dict(db_maintenance.QUERIES, gather_ratings_join=f'SELECT count(*), total(timbre), total(plausibility) FROM ({extract_data.RATINGS_QUERY})')
+    return {name: min(_timed(lambda: cursor.execute(query).fetchall())[1] for _ in range(repeats)) for name, query in queries.items()}
+
+
+def benchmark_indexes(n_ratings: int = 10 ** 6, n_recordings: int = 192, repeats: int = 3, seed: int = 0) -> dict:
+    """
+    Time of the project's queries on a synthetic database of about n_ratings
+    ratings, without indexes and after db_maintenance.maintain, with the
+    query plans before and after.
+    """
+    n_users = -(-n_ratings // n_recordings) + 1
+    db_path = extract_data.create_synthetic_db(n_users = n_users, n_recordings = n_recordings, seed = seed)
+    try:
+        with closing(sqlite3.connect(db_path)) as connection:
+            before = _query_times(connection.cursor(), repeats)
+            plans_before = db_maintenance.query_plans(connection.cursor())
+        report = db_maintenance.maintain(db_path)
+        with closing(sqlite3.connect(db_path)) as connection:
+            after = _query_times(connection.cursor(), repeats)
+    finally:
+        _remove_db(db_path)
+
+    return {
+        'ratings': (n_users - 1) * n_recordings,
+        'queries': {name: {'before_s': before[name], 'after_s': after[name], 'speedup': before[name] / after[name]} for name in before},
+        'plans_before': plans_before,
+        'plans_after': report['plans'],
+        'invalid_indexes': report['invalid'],
+    }
+
+
+def _simulated_app(db_path: str, duration: float, results) -> None:
+    """Listening test app stand-in: one rating committed per transaction, never waiting for a lock."""
+    connection = sqlite3.connect(db_path, timeout=0)
+    commits, locked, latencies = 0, 0, []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            with connection:
+                connection.execute('INSERT INTO ratings (user_id, recording_id, timbre, plausibility, source_width) VALUES (?, ?, ?, ?, ?)', (2, 1, .5, .5, .5))
+            commits += 1
+            latencies.append(time.perf_counter() - start)
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+        time.sleep(.002)
+    connection.close()
+    results.put({'commits': commits, 'locked': locked, 'max_commit_ms': 1e3 * max(latencies, default = 0.)})
+
+
+def _analysis_reader(db_path: str, stop, results) -> None:
+    """Analysis script stand-in: the ratings read in full, over and over, through database.reader."""
+    reads = 0
+    while not stop.is_set():
+        extract_data.read_ratings(database.reader(db_path).cursor())
+        reads += 1
+    database.close(db_path)
+    results.put({'reads': reads})
+
+
+def check_concurrency(n_ratings: int = 2 * 10 ** 5, readers: int = 2, duration: float = 10., n_recordings: int = 192) -> dict:
+    """
+    Run a simulated app writing to a synthetic database while analysis
+    readers read it in a loop, each in its own process, and raise
+    RuntimeError if any of the app's commits hit 'database is locked'.
+    """
+    n_users = -(-n_ratings // n_recordings) + 1
+    db_path = extract_data.create_synthetic_db(n_users = n_users, n_recordings = n_recordings)
+    database.close(db_path)
+    try:
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target = _analysis_reader, args = (db_path, stop, results)) for _ in range(readers)]
+        for process in processes:
+            process.start()
+        app = multiprocessing.Process(target = _simulated_app, args = (db_path, duration, results))
+        app.start()
+        app.join()
+        stop.set()
+        reports = [results.get() for _ in range(readers + 1)]
+        for process in processes:
+            process.join()
+    finally:
+        _remove_db(db_path)
+
+    report = next(report for report in reports if 'commits' in report)
+    report['reads'] = [report['reads'] for report in reports if 'reads' in report]
+    if report['locked'] or not all(report['reads']):
+        raise RuntimeError(f'Readers blocked the simulated app, or did not read: {report}')
+    return report
+
+
+def write_synthetic_headrots(file_name: str, n_samples: int = 6000, seed: int = 0) -> None:
+    """HeadRots file of a random walk of the head, in the tracker's 'x y z w _ ' format."""
+    rng = np.random.default_rng(seed)
+    euler = np.cumsum(rng.normal(scale = [.5, .2, .1], size = (n_samples, 3)), axis = 0)
+    quats = Rotation.from_euler('xyz', euler, degrees = True).as_quat()
+    with open(file_name, 'w') as f:
+        f.write(''.join(f'{x:.6f} {y:.6f} {z:.6f} {w:.6f} _ ' for x, y, z, w in quats))
+
+
+def check_head_tracking(file_name: str = None, chunk_sizes: tuple = (1, 7, 64, 333), tolerance: float = 1e-8) -> dict:
+    """
+    Feed a HeadRots file (a synthetic one by default) to
+    head_tracking.HeadMovementFilter in uneven chunks, and raise
+    RuntimeError if the concatenated output differs from
+    movement_analysis.create_data_frame by more than tolerance degrees.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        if file_name is None:
+            file_name = os.path.join(folder, 'HeadRots_synthetic.txt')
+            write_synthetic_headrots(file_name)
+        quats = ma.parse_quaternions(ma.read_quaternions(file_name))
+        offline = ma.create_data_frame(file_name)[[ma._yaw, ma._pitch, ma._roll]].to_numpy()
+
+    tracker = head_tracking.HeadMovementFilter()
+    chunks, begin = [], 0
+    while begin < len(quats):
+        size = chunk_sizes[len(chunks) % len(chunk_sizes)]
+        chunks.append(tracker.update(quats[begin:begin + size]))
+        begin += size
+    streamed = np.concatenate(chunks)
+
+    report = {'samples': len(quats), 'chunks': len(chunks), 'max_abs_diff': float(np.amax(np.abs(streamed - offline), initial = 0.))}
+    if streamed.shape != offline.shape or not report['max_abs_diff'] <= tolerance:
+        raise RuntimeError(f'HeadMovementFilter differs from movement_analysis.create_data_frame: {report}')
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark of the ratings analysis on a synthetic database.')
+    parser.add_argument('--ratings', type=int, default=10 ** 6, help='number of ratings in the synthetic database')
+    parser.add_argument('--indexes', action='store_true', help='only report the query times before and after db_maintenance')
+    parser.add_argument('--concurrency', action='store_true', help='only check that the analysis readers never block a simulated app writer')
+    parser.add_argument('--head-tracking', nargs='?', const='', metavar='HEADROTS_FILE', help='only check that the streamed head movement filter matches movement_analysis on a HeadRots file (a synthetic one by default)')
+    args = parser.parse_args()
+
+    if args.head_tracking is not None:
+        print(json.dumps(check_head_tracking(args.head_tracking or None), indent=1))
+        return
+
+    if args.concurrency:
+        print(json.dumps(check_concurrency(), indent=1))
+        return
+
+    if args.indexes:
+        print(json.dumps(benchmark_indexes(args.ratings), indent=1))
+        return
+
+    print(json.dumps(benchmark_get_dataframe(args.ratings), indent=1))
+
+
+if __name__ == '__main__':
+    main()
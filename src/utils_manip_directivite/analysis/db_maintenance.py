@@ -0,0 +1,89 @@
+import argparse
+import sqlite3
+from utils_manip_directivite import DB_PATH, database
+from utils_manip_directivite.analysis import extract_data
+from utils_manip_directivite.sentences_recording import files_filter
+
+# ratings_recording_id covers every ratings column of gather_ratings, so that
+# the join reads the index alone; the recordings indexes cover the join keys
+INDEXES = {
+    'ratings_recording_id': ('ratings', ['recording_id', 'user_id', 'timbre', 'plausibility', 'angle', 'movement']),
+    'ratings_user_id': ('ratings', ['user_id', 'recording_id']),
+    'recordings_conditions_id': ('recordings', ['conditions_id', 'room_id', 'sentence_id', 'repetition']),
+    'recordings_room_id': ('recordings', ['room_id']),
+    'recordings_sentence_id': ('recordings', ['sentence_id']),
+}
+QUERIES = {
+    'gather_ratings': extract_data.RATINGS_QUERY,
+    'add_dummy_ratings': extract_data.RECORDINGS_QUERY,
+    'get_birth_dates': extract_data.BIRTH_DATES_QUERY,
+    'get_all_audio_files': files_filter.AUDIO_FILES_QUERY,
+}
+
+def create_indexes(cursor: sqlite3.Cursor) -> list:
+    """Create the missing INDEXES, and rebuild those defined on other columns."""
+    created = check_indexes(cursor)
+    for name in created:
+        table, columns = INDEXES[name]
+        cursor.execute(f'DROP INDEX IF EXISTS {name}')
+        cursor.execute(f'CREATE INDEX {name} ON {table} ({", ".join(columns)})')
+    return created
+
+def drop_indexes(cursor: sqlite3.Cursor) -> None:
+    for name in INDEXES:
+        cursor.execute(f'DROP INDEX IF EXISTS {name}')
+
+def check_indexes(cursor: sqlite3.Cursor) -> list:
+    """Names of the INDEXES missing from the database, or defined on other columns."""
+    return [name for name, (table, columns) in INDEXES.items()
+            if [row[2] for row in cursor.execute(f'PRAGMA index_info({name})')] != columns]
+
+def analyze(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('ANALYZE')
+
+def query_plans(cursor: sqlite3.Cursor) -> dict:
+    """EXPLAIN QUERY PLAN of each of the project's queries, one line per step."""
+    return {name: [row[3] for row in cursor.execute(f'EXPLAIN QUERY PLAN {query}')] for name, query in QUERIES.items()}
+
+def maintain(db_path: str = DB_PATH) -> dict:
+    """Switch the database to WAL mode, create the missing indexes, refresh the planner statistics and check the result."""
+    journal_mode = database.enable_wal(db_path)
+    with database.writer(db_path) as connection:
+        cursor = connection.cursor()
+        created = create_indexes(cursor)
+        analyze(cursor)
+    return {'journal_mode': journal_mode, 'created': created, 'invalid': check_indexes(cursor), 'plans': query_plans(cursor)}
+
+def print_plans(plans: dict) -> None:
+    for name, plan in plans.items():
+        print(name)
+        for step in plan:
+            print(f'    {step}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Create and check the indexes of the ratings database, and report the query plans.')
+    parser.add_argument('db', nargs='?', default=DB_PATH, help='database file')
+    parser.add_argument('--check', action='store_true', help='only report the journal mode, the missing indexes and the current plans, without changing the database')
+    parser.add_argument('--drop', action='store_true', help='drop the indexes instead')
+    args = parser.parse_args()
+
+    if args.check or args.drop:
+        if args.drop:
+            with database.writer(args.db) as connection:
+                drop_indexes(connection.cursor())
+        cursor = database.reader(args.db).cursor()
+        print(f'Journal mode: {cursor.execute("PRAGMA journal_mode").fetchone()[0]}')
+        print(f'Missing or invalid indexes: {check_indexes(cursor)}')
+        print_plans(query_plans(cursor))
+        return
+
+    report = maintain(args.db)
+    print(f'Journal mode: {report["journal_mode"]}')
+    print(f'Created indexes: {report["created"]}')
+    print(f'Missing or invalid indexes: {report["invalid"]}')
+    print_plans(report['plans'])
+    if report['invalid']:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,45 @@
 import sqlite3
+import os
+import tempfile
+from contextlib import closing
 from datetime import date
-from random import gauss
+from itertools import product
+import numpy as np
 import pandas as pd
-from utils_manip_directivite import DB_PATH
-from scipy.stats import zscore
-from datetime import date
+from pandas.api.types import union_categoricals
+from utils_manip_directivite import DB_PATH, database
 from statistics import mean, stdev
 
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS conditions (id INTEGER PRIMARY KEY, distance INTEGER NOT NULL, angle TEXT NOT NULL, movement INTEGER NOT NULL, source TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS sentences (id INTEGER PRIMARY KEY, amplitude TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS recordings (id INTEGER PRIMARY KEY, room_id INTEGER NOT NULL REFERENCES rooms (id), conditions_id INTEGER NOT NULL REFERENCES conditions (id), sentence_id INTEGER NOT NULL REFERENCES sentences (id), repetition INTEGER NOT NULL, audio_file TEXT);
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, birth_date TEXT);
+CREATE TABLE IF NOT EXISTS ratings (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), recording_id INTEGER NOT NULL REFERENCES recordings (id), timbre REAL, plausibility REAL, source_width REAL, angle REAL, movement REAL);
+"""
+RATINGS_QUERY = """SELECT users.id, rooms.name, conditions.distance, conditions.angle, conditions.movement, conditions.source, sentences.amplitude, recordings.repetition, ratings.timbre, ratings.plausibility, ratings.angle, ratings.movement
+    FROM ratings 
+    INNER JOIN recordings ON ratings.recording_id = recordings.id
+    INNER JOIN rooms ON recordings.room_id = rooms.id
+    INNER JOIN users ON ratings.user_id = users.id
+    INNER JOIN conditions ON recordings.conditions_id = conditions.id
+    INNER JOIN sentences ON recordings.sentence_id = sentences.id
+    WHERE users.id > 1"""
+RATINGS_COLUMNS = ['user', 'room', 'distance', 'angle', 'movement', 'source', 'amplitude', 'repetition', 'answer_timbre', 'answer_plausibility', 'answer_angle', 'answer_movement']
+RECORDINGS_QUERY = 'SELECT recordings.id, conditions.movement, conditions.source FROM recordings INNER JOIN conditions ON recordings.conditions_id = conditions.id'
+BIRTH_DATES_QUERY = "SELECT users.birth_date FROM users WHERE users.id > 1"
+CATEGORICAL_COLUMNS = ['room', 'angle', 'source', 'amplitude']
+ANSWER_COLUMNS = ['answer_timbre', 'answer_plausibility', 'answer_angle', 'answer_movement']
+STIMULI = ['Dyn1', 'Dyn2', 'Sta1', 'Sta2']
+
 def delete_users(cursor: sqlite3.Cursor) -> None:
     cursor.execute('DELETE FROM users')
 
 def delete_ratings(cursor: sqlite3.Cursor) -> None:
     cursor.execute('DELETE FROM ratings')
 
-def add_dummy_users(cursor: sqlite3.Cursor) -> None:
+def add_dummy_users(cursor: sqlite3.Cursor, n_users: int = None, rng: np.random.Generator = None) -> None:
     users = [
         ['Gauthier', 'Berthomieu', date(1994, 6, 16)],
         ['Justine', 'Provost', date(1990, 5, 9)],
@@ -27,50 +53,82 @@ def add_dummy_users(cursor: sqlite3.Cursor) -> None:
         ['Ariel', 'Pink', date(1978, 6, 24)],
         ['Aphex', 'Twin', date(1971, 8, 18)]
         ]
-    
-    for user in users:
-        cursor.execute(f'INSERT INTO users (first_name,last_name,birth_date) VALUES ("{user[0]}", "{user[1]}", "{user[2]}")')
+    if n_users is not None:
+        rng = np.random.default_rng() if rng is None else rng
+        days = rng.integers(date(1960, 1, 1).toordinal(), date(2005, 1, 1).toordinal(), n_users)
+        users = [['Participant', str(i), date.fromordinal(int(day))] for i, day in enumerate(days, start = 1)]
+
+    cursor.executemany('INSERT INTO users (first_name,last_name,birth_date) VALUES (?, ?, ?)', [(first_name, last_name, str(birth_date)) for first_name, last_name, birth_date in users])
+
+def random_ratings(movements: np.ndarray, sources: np.ndarray, rng: np.random.Generator = None) -> np.ndarray:
+    """Timbre, width and plausibility of one rating per recording (N x 3), drawn as in set_random_ratings."""
+    rng = np.random.default_rng() if rng is None else rng
+    is_dynamic = np.asarray(movements) == 0
+    is_human = np.asarray(sources) == 'Human'
+    timbre = rng.normal(.5, .5, len(is_human))
+    width = rng.normal(np.where(is_human, .7, .4), .3)
+    plausibility_mean = np.where(is_human, .6, .4) + np.where(is_dynamic, .2, -.2)
+    plausibility_sigma = np.where(is_human, .1, .4)
+    plausibility = rng.normal(plausibility_mean, plausibility_sigma)
+
+    return np.clip(np.column_stack((timbre, width, plausibility)), 0., 1.)
 
 def set_random_ratings(recording: tuple) -> tuple:
-    is_dynamic = recording[1] == 0
-    is_human = recording[2] == 'Human'
-    timbre = gauss(.5, .5)
-    width = gauss(.7 if is_human else .4, .3)
-    plausibility_mean = .6 if is_human else .4
-    plausibility_mean = plausibility_mean + (0.2 if is_dynamic else -0.2)
-    plausibily_sigma = .1 if is_human else .4
-    plausibility = gauss(plausibility_mean, plausibily_sigma)
-    
-    (t,w,p) = (min(1.,max(0.,v)) for v in (timbre, width, plausibility))
+    (t,w,p) = random_ratings([recording[1]], [recording[2]])[0].tolist()
     return (t,w,p)
 
-def add_dummy_ratings(cursor: sqlite3.Cursor) -> None:
-    recordings  = cursor.execute('SELECT recordings.id, conditions.movement, conditions.source FROM recordings INNER JOIN conditions ON recordings.conditions_id = conditions.id').fetchall()
+def add_dummy_ratings(cursor: sqlite3.Cursor, rng: np.random.Generator = None) -> None:
+    recordings  = cursor.execute(RECORDINGS_QUERY).fetchall()
     user_ids = [i[0] for i in cursor.execute('SELECT id FROM users').fetchall()]
-    for user_id in user_ids:
-        for recording in recordings:
-            recording_id = recording[0]
-            timbre, width, plausibility = set_random_ratings(recording)
-            cursor.execute(f'INSERT INTO ratings (user_id, recording_id, timbre, plausibility, source_width) VALUES ({user_id}, {recording_id}, {timbre}, {plausibility}, {width})')
-
-def fill_db_with_random_data() -> None:    
-    with sqlite3.connect(DB_PATH) as connection:
+    if not recordings or not user_ids:
+        return
+
+    recording_ids, movements, sources = (np.array(column) for column in zip(*recordings))
+    timbre, width, plausibility = random_ratings(np.tile(movements, len(user_ids)), np.tile(sources, len(user_ids)), rng).T
+    rows = zip(np.repeat(user_ids, len(recording_ids)).tolist(), np.tile(recording_ids, len(user_ids)).tolist(), timbre.tolist(), plausibility.tolist(), width.tolist())
+    cursor.executemany('INSERT INTO ratings (user_id, recording_id, timbre, plausibility, source_width) VALUES (?, ?, ?, ?, ?)', rows)
+
+def fill_db_with_random_data(n_users: int = None, db_path: str = DB_PATH) -> None:
+    with database.writer(db_path) as connection:
         cursor = connection.cursor()
         delete_users(cursor)
         delete_ratings(cursor)
-        add_dummy_users(cursor)
+        add_dummy_users(cursor, n_users)
         add_dummy_ratings(cursor)
 
+def add_dummy_recordings(cursor: sqlite3.Cursor, n_recordings: int) -> None:
+    """Rooms, conditions and sentences of the experiment, and n_recordings recordings cycling through their combinations."""
+    cursor.executemany('INSERT INTO rooms (name) VALUES (?)', [('CLOUS',), ('SUAPS',)])
+    cursor.executemany('INSERT INTO conditions (distance, angle, movement, source) VALUES (?, ?, ?, ?)', product([1, 4], ['Front', 'Side'], [0, 1], ['Human', 'Loudspeaker']))
+    cursor.executemany('INSERT INTO sentences (amplitude) VALUES (?)', [('Small',), ('Large',)])
+
+    combinations = list(product([1, 2], range(1, 17), [1, 2]))
+    recordings = ((*combinations[i % len(combinations)], 1 + i // len(combinations)) for i in range(n_recordings))
+    cursor.executemany('INSERT INTO recordings (room_id, conditions_id, sentence_id, repetition, audio_file) VALUES (?, ?, ?, ?, ?)',
+                       ((room_id, conditions_id, sentence_id, repetition, f'{room_id}_{conditions_id}_{sentence_id}_{repetition}.wav') for room_id, conditions_id, sentence_id, repetition in recordings))
+
+def create_synthetic_db(db_path: str = None, n_users: int = 11, n_recordings: int = 192, seed: int = None) -> str:
+    """
+    Database with the schema gather_ratings expects, n_users random users and
+    one random rating per user and recording, for load tests of the analysis.
+
+    :return: db_path, or the path of a new temporary file when None
+    """
+    if db_path is None:
+        fd, db_path = tempfile.mkstemp(suffix = '.db')
+        os.close(fd)
+    rng = np.random.default_rng(seed)
+    with closing(database.connect(db_path)) as connection:
+        connection.executescript(SCHEMA)
+        with connection:
+            cursor = connection.cursor()
+            add_dummy_recordings(cursor, n_recordings)
+            add_dummy_users(cursor, n_users, rng)
+            add_dummy_ratings(cursor, rng)
+    return db_path
+
 def gather_ratings(cursor: sqlite3.Cursor) -> list:
-    query = """SELECT users.id, rooms.name, conditions.distance, conditions.angle, conditions.movement, conditions.source, sentences.amplitude, recordings.repetition, ratings.timbre, ratings.plausibility, ratings.angle, ratings.movement
-    FROM ratings 
-    INNER JOIN recordings ON ratings.recording_id = recordings.id
-    INNER JOIN rooms ON recordings.room_id = rooms.id
-    INNER JOIN users ON ratings.user_id = users.id
-    INNER JOIN conditions ON recordings.conditions_id = conditions.id
-    INNER JOIN sentences ON recordings.sentence_id = sentences.id
-    WHERE users.id > 1"""
-    ratings = cursor.execute(query)
+    ratings = cursor.execute(RATINGS_QUERY)
     return ratings
 
 def stimulus_col(row):
@@ -78,32 +136,45 @@ def stimulus_col(row):
     sentence_structure = '1' if row['amplitude'] == 'Small' else '2'
     return movement + sentence_structure
 
-def get_dataframe(z_score: bool) -> pd.DataFrame:
-    ratings = []
+def read_ratings(cursor: sqlite3.Cursor, chunksize: int = 100000) -> pd.DataFrame:
+    """Result of gather_ratings fetched chunksize rows at a time, with categorical text columns."""
+    ratings_cursor = gather_ratings(cursor)
+    chunks = []
+    while rows := ratings_cursor.fetchmany(chunksize):
+        chunk = pd.DataFrame.from_records(rows, columns = RATINGS_COLUMNS)
+        chunk[CATEGORICAL_COLUMNS] = chunk[CATEGORICAL_COLUMNS].astype('category')
+        chunk[ANSWER_COLUMNS] = chunk[ANSWER_COLUMNS].astype(float)
+        chunks.append(chunk)
+    if not chunks:
+        return pd.DataFrame(columns = RATINGS_COLUMNS).astype({column: 'category' for column in CATEGORICAL_COLUMNS} | {column: float for column in ANSWER_COLUMNS})
+
+    df = pd.concat(chunks, ignore_index = True)
+    for column in CATEGORICAL_COLUMNS:
+        df[column] = union_categoricals([chunk[column] for chunk in chunks], sort_categories = True)
+    return df
 
-    with sqlite3.connect(DB_PATH) as connection:
-        cursor = connection.cursor()
+def stimulus_column(df: pd.DataFrame) -> pd.Categorical:
+    """stimulus_col of every row at once."""
+    codes = np.where(df['movement'].astype(bool), 0, 2) + np.where(df['amplitude'] == 'Small', 0, 1)
+    return pd.Categorical.from_codes(codes, categories = STIMULI).remove_unused_categories()
 
-        ratings_cursor = gather_ratings(cursor)
-        for rating in ratings_cursor:
-            ratings.append(list(rating))
+def get_dataframe(z_score: bool, db_path: str = DB_PATH, chunksize: int = 100000) -> pd.DataFrame:
+    df = read_ratings(database.reader(db_path).cursor(), chunksize)
 
-    df = pd.DataFrame(ratings, columns = ['user', 'room', 'distance', 'angle', 'movement', 'source', 'amplitude', 'repetition', 'answer_timbre', 'answer_plausibility', 'answer_angle', 'answer_movement'])
-    df['stimulus'] = df.apply(stimulus_col, axis = 1)
+    df['stimulus'] = stimulus_column(df)
     df = df[['user', 'room', 'distance', 'angle', 'stimulus', 'source', 'repetition', 'answer_timbre', 'answer_plausibility', 'answer_angle', 'answer_movement']]
-    df = df.groupby(['user', 'room', 'distance', 'angle', 'stimulus', 'source'], as_index = False)[['answer_timbre', 'answer_plausibility', 'answer_angle', 'answer_movement']].mean()
+    df = df.groupby(['user', 'room', 'distance', 'angle', 'stimulus', 'source'], as_index = False, observed = True)[ANSWER_COLUMNS].mean()
 
     if z_score:
-        for rating in ['answer_plausibility', 'answer_timbre']:
-            df[rating] = df.groupby('user')[rating].transform(lambda x: zscore(x, ddof = 1))
+        ratings = ['answer_plausibility', 'answer_timbre']
+        by_user = df.groupby('user')[ratings]
+        df[ratings] = (df[ratings] - by_user.transform('mean')) / by_user.transform('std')
 
     return df
 
-def get_birth_dates() -> list:
-    with sqlite3.connect(DB_PATH) as connection:
-        cursor = connection.cursor()
-        query = "SELECT users.birth_date FROM users WHERE users.id > 1"
-        birth_dates = [date(*[int(s) for s in c[0].split('-')]) for c in cursor.execute(query)]
+def get_birth_dates(db_path: str = DB_PATH) -> list:
+    cursor = database.reader(db_path).cursor()
+    birth_dates = [date(*[int(s) for s in c[0].split('-')]) for c in cursor.execute(BIRTH_DATES_QUERY)]
     return birth_dates
 
 def age(birth_date: date):
@@ -0,0 +1,113 @@
+import time
+import numpy as np
+import scipy.signal
+from scipy.spatial.transform import Rotation
+from utils_manip_directivite.analysis import movement_analysis as ma
+
+
+class HeadMovementFilter:
+    """
+    Tracker quaternions to low-passed yaw, pitch and roll, chunk by chunk.
+
+    Each chunk is converted to Euler angles in one Rotation call, then
+    filtered by the Butterworth low-pass of movement_analysis.filter_data_frame
+    in second-order sections, with the filter state carried over from one
+    chunk to the next. As offline, the first sample is subtracted before
+    filtering and added back after, so the concatenated output matches
+    movement_analysis.create_data_frame.
+    """
+
+    def __init__(self, order: int = 4, cutoff: float = 2.5, fs: float = 1 / ma.PERIOD):
+        self.sos = scipy.signal.iirfilter(order, Wn=cutoff, fs=fs, btype='low', ftype='butter', output='sos')
+        self.reset()
+
+    def reset(self) -> None:
+        self._zi = np.zeros((len(self.sos), 2, 3))
+        self._offset = None
+        self.samples = 0
+
+    def update(self, quats: np.ndarray) -> np.ndarray:
+        """
+        :param quats: (N, 4) X, Y, Z, W quaternions
+        :return: (N, 3) filtered yaw, pitch and roll (degrees)
+        """
+        quats = np.asarray(quats, dtype=float).reshape((-1, 4))
+        if len(quats) == 0:
+            return np.zeros((0, 3))
+        euler = Rotation.from_quat(quats).as_euler('xyz', degrees=True)
+        if self._offset is None:
+            self._offset = euler[0].copy()
+        filtered, self._zi = scipy.signal.sosfilt(self.sos, euler - self._offset, axis=0, zi=self._zi)
+        self.samples += len(quats)
+        return filtered + self._offset
+
+
+class HeadMovementComparison:
+    """
+    Original and reproduced head movements filtered as they arrive, with
+    running statistics of their yaw and pitch differences over the samples
+    received from both streams so far.
+    """
+
+    def __init__(self):
+        self.original = HeadMovementFilter()
+        self.repro = HeadMovementFilter()
+        self._pending = {'original': np.zeros((0, 3)), 'repro': np.zeros((0, 3))}
+        self.count = 0
+        self._abs_sum = np.zeros(2)
+        self._max = np.zeros(2)
+
+    def update(self, original: np.ndarray = None, repro: np.ndarray = None) -> tuple:
+        """
+        Feed the next quaternions of either stream.
+
+        :return: filtered (N, 3) yaw, pitch and roll of the original and repro chunks
+        """
+        outputs = []
+        for role, quats in [('original', original), ('repro', repro)]:
+            euler = getattr(self, role).update(quats) if quats is not None else np.zeros((0, 3))
+            self._pending[role] = np.concatenate((self._pending[role], euler))
+            outputs.append(euler)
+
+        n = min(len(self._pending['original']), len(self._pending['repro']))
+        if n:
+            diff = np.abs(self._pending['original'][:n, :2] - self._pending['repro'][:n, :2])
+            self._abs_sum += np.sum(diff, axis=0)
+            self._max = np.maximum(self._max, np.amax(diff, axis=0))
+            self.count += n
+            for role in self._pending:
+                self._pending[role] = self._pending[role][n:]
+        return tuple(outputs)
+
+    def stats(self) -> dict:
+        mean = self._abs_sum / self.count if self.count else np.full(2, np.nan)
+        return {
+            'samples': self.count,
+            'mean_yaw_diff': float(mean[0]),
+            'mean_pitch_diff': float(mean[1]),
+            'max_yaw_diff': float(self._max[0]),
+            'max_pitch_diff': float(self._max[1]),
+        }
+
+    def mean_angular_diffs(self) -> tuple:
+        """Same as movement_analysis.mean_angular_diffs on the samples received so far."""
+        mean = self._abs_sum / self.count if self.count else np.full(2, np.nan)
+        return tuple(round(float(value), 1) for value in mean)
+
+
+def replay(original_file: str, repro_file: str, chunk_size: int = 10, realtime: bool = False):
+    """
+    Stand-in for the live tracker: feed two recorded HeadRots files to a
+    HeadMovementComparison, chunk_size samples at a time, optionally at the
+    tracker rate.
+
+    :return: generator of (filtered original chunk, filtered repro chunk, running stats)
+    """
+    streams = [ma.load_quaternions(original_file), ma.load_quaternions(repro_file)]
+    comparison = HeadMovementComparison()
+    start = time.perf_counter()
+    for begin in range(0, max(len(quats) for quats in streams), chunk_size):
+        if realtime:
+            time.sleep(max(0., start + (begin + chunk_size) * ma.PERIOD - time.perf_counter()))
+        original, repro = comparison.update(*[quats[begin:begin + chunk_size] for quats in streams])
+        yield original, repro, comparison.stats()
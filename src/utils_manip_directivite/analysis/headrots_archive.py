@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from utils_manip_directivite import HEADROTS_FOLDER
+from utils_manip_directivite.analysis import movement_analysis as ma
+
+ARCHIVE_FOLDER = os.path.join(HEADROTS_FOLDER, '.archive')
+ROLES = {'original': '', 'repro': '_1'}
+SUFFIXES = {'original': '_o', 'repro': '_r'}
+_DTYPE = np.dtype('<f8')
+_QUATERNIONS_FILE = 'quaternions.f8'
+_EULER_FILE = 'euler.f8'
+_COLUMNS = {_QUATERNIONS_FILE: 4, _EULER_FILE: 3}
+_INDEX_FILE = 'index.json'
+
+
+class HeadRotsArchive:
+    """
+    Every HeadRots take in two flat binary files: the raw quaternions (N x 4)
+    and the filtered yaw, pitch and roll (N x 3) of all takes, one after the
+    other, with an index giving the offset and length of each take.
+
+    Ingestion writes the files that are new or changed (by size and
+    modification time) after the last take of the index, and rewrites the
+    index after each of them, so that the archive can be read while it is
+    ingesting. Rows written by an interrupted run are past the end of the
+    index, and are truncated by the next ingestion; reading never writes to
+    the files. Compaction
+    writes a new generation of the data files and switches the index to it
+    in one atomic replace. Loading memory-maps both files once and slices
+    the requested takes out of them.
+    """
+
+    def __init__(self, folder: str = ARCHIVE_FOLDER):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._index = self._read_index()
+
+    def ingest(self, source_folder: str = HEADROTS_FOLDER) -> list:
+        """
+        Add the new or changed {ID}.txt / {ID}_1.txt files of source_folder.
+
+        :return: keys (ID, role) of the ingested takes
+        """
+        self._index = self._read_index()
+        self._truncate()
+        ingested = []
+        for name in sorted(os.listdir(source_folder)):
+            key = parse_take_file_name(name)
+            if key is None:
+                continue
+            path = os.path.join(source_folder, name)
+            stat = os.stat(path)
+            entry = self._takes.get(_index_key(*key))
+            if entry is not None and entry['stat'] == [stat.st_size, stat.st_mtime_ns]:
+                continue
+            quats = ma.parse_quaternions(ma.read_quaternions(path))
+            euler = ma.filter_data_frame(ma.create_ypr_data_frame(pd.DataFrame(quats, columns=['X', 'Y', 'Z', 'W'])))
+            offset = self._append(quats, euler[[ma._yaw, ma._pitch, ma._roll]].to_numpy())
+            self._takes[_index_key(*key)] = {'offset': offset, 'length': len(quats), 'stat': [stat.st_size, stat.st_mtime_ns]}
+            self._write_index()
+            ingested.append(key)
+        return ingested
+
+    def keys(self) -> list:
+        return [tuple(key.split('/')) for key in self._takes]
+
+    def load(self, take_ids: list = None, roles: tuple = tuple(ROLES)) -> dict:
+        """
+        Quaternions and filtered Euler angles of a subset of takes (all by
+        default), sliced from a single memory map of each archive file.
+
+        :return: {(ID, role): (quaternions, euler)}
+        """
+        keys = self.keys() if take_ids is None else [(str(take_id), role) for take_id in take_ids for role in roles]
+        quaternions, euler = self._maps()
+        takes = {}
+        for take_id, role in keys:
+            entry = self._takes.get(_index_key(take_id, role))
+            if entry is None:
+                raise KeyError(f"Take {take_id} ({role}) is not in the archive")
+            if entry['offset'] + entry['length'] > min(len(quaternions), len(euler)):
+                raise ValueError(f"Take {take_id} ({role}) is past the end of the archive files in {self.folder}")
+            rows = slice(entry['offset'], entry['offset'] + entry['length'])
+            takes[take_id, role] = quaternions[rows], euler[rows]
+        return takes
+
+    def data_frame(self, take_id, role: str = 'original', suffix: str = None) -> pd.DataFrame:
+        """Filtered yaw, pitch and roll of a take, as returned by movement_analysis.create_data_frame."""
+        return ma.create_euler_data_frame(self.load([take_id], (role,))[str(take_id), role][1], SUFFIXES[role] if suffix is None else suffix)
+
+    def compact(self) -> None:
+        """Rewrite the archive without the data of superseded versions of the takes."""
+        quaternions, euler = (np.array(a) for a in self._maps())
+        generation = self._index['generation'] + 1
+        takes = {}
+        offset = 0
+        with open(self._path(_QUATERNIONS_FILE, generation), 'wb') as quaternions_file, \
+                open(self._path(_EULER_FILE, generation), 'wb') as euler_file:
+            for key, entry in self._takes.items():
+                rows = slice(entry['offset'], entry['offset'] + entry['length'])
+                quaternions_file.write(np.ascontiguousarray(quaternions[rows], dtype=_DTYPE).tobytes())
+                euler_file.write(np.ascontiguousarray(euler[rows], dtype=_DTYPE).tobytes())
+                takes[key] = dict(entry, offset=offset)
+                offset += entry['length']
+
+        superseded = [self._path(name) for name in _COLUMNS]
+        self._index = {'generation': generation, 'takes': takes}
+        self._write_index()
+        for path in superseded:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @property
+    def _takes(self) -> dict:
+        return self._index['takes']
+
+    def _path(self, name: str, generation: int = None) -> str:
+        """Path of a data file of the given generation (the current one by default)."""
+        generation = self._index['generation'] if generation is None else generation
+        stem, extension = os.path.splitext(name)
+        return os.path.join(self.folder, f'{stem}.{generation}{extension}' if generation else name)
+
+    def _end(self) -> int:
+        """Number of rows of the data files referenced by the index."""
+        return max((entry['offset'] + entry['length'] for entry in self._takes.values()), default=0)
+
+    def _truncate(self) -> None:
+        """Drop the rows an interrupted ingestion wrote past the end of the index (before ingesting only)."""
+        for name, columns in _COLUMNS.items():
+            path = self._path(name)
+            size = self._end() * columns * _DTYPE.itemsize
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def _maps(self) -> tuple:
+        return tuple(self._map(name, columns) for name, columns in _COLUMNS.items())
+
+    def _map(self, name: str, columns: int) -> np.ndarray:
+        path = self._path(name)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros((0, columns), dtype=_DTYPE)
+        return np.memmap(path, dtype=_DTYPE, mode='r').reshape((-1, columns))
+
+    def _append(self, quaternions: np.ndarray, euler: np.ndarray) -> int:
+        """Write the rows of a take after the end of the index, and return their offset."""
+        offset = self._end()
+        for (name, columns), data in zip(_COLUMNS.items(), [quaternions, euler]):
+            path = self._path(name)
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                f.seek(offset * columns * _DTYPE.itemsize)
+                f.write(np.ascontiguousarray(data, dtype=_DTYPE).tobytes())
+                f.truncate()
+        return offset
+
+    def _read_index(self) -> dict:
+        try:
+            with open(os.path.join(self.folder, _INDEX_FILE)) as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'generation': 0, 'takes': {}}
+        # archives written before the generations were introduced hold the takes only
+        return index if 'takes' in index else {'generation': 0, 'takes': index}
+
+    def _write_index(self) -> None:
+        fd, temp_file = tempfile.mkstemp(dir=self.folder, prefix='.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(temp_file, os.path.join(self.folder, _INDEX_FILE))
+
+
+def parse_take_file_name(name: str) -> tuple:
+    """(ID, role) of a HeadRots file name, or None for other files."""
+    stem, extension = os.path.splitext(name)
+    if extension != '.txt':
+        return None
+    if stem.endswith(ROLES['repro']):
+        return stem[:-len(ROLES['repro'])], 'repro'
+    return stem, 'original'
+
+
+def _index_key(take_id, role: str) -> str:
+    return f'{take_id}/{role}'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Ingest the new or changed HeadRots files into the take archive.')
+    parser.add_argument('source', nargs='?', default=HEADROTS_FOLDER, help='folder of the {ID}.txt / {ID}_1.txt files')
+    parser.add_argument('--archive', default=None, help='archive folder (<source>/.archive by default)')
+    parser.add_argument('--compact', action='store_true', help='drop the data of superseded takes afterwards')
+    args = parser.parse_args()
+
+    archive = HeadRotsArchive(args.archive or os.path.join(args.source, '.archive'))
+    ingested = archive.ingest(args.source)
+    if args.compact:
+        archive.compact()
+    print(f'{len(ingested)} files ingested, {len(archive.keys())} in the archive')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,20 @@
+import numpy as np
 import pandas as pd
 from scipy.spatial.transform import Rotation
+import matplotlib
 import matplotlib.pyplot as plt
+import scipy.fft
 import scipy.signal
+import glob
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from utils_manip_directivite import HEADROTS_FOLDER
 
 (_yaw, _pitch, _roll) = ('Yaw', 'Pitch', 'Roll')
+PERIOD = 0.01
+FIGURES_FOLDER = r'C:\Users\labsticc\Documents\Manips\Gauthier\Directivité\Enregistrement_Anechoique\HeadRots_figs'
 
 def get_df_suffixed_axes_labels(data_frame: pd.DataFrame) -> list[str]:
     return [axis for axis in data_frame.columns if any(map(lambda a: a in axis, [_yaw, _pitch]))]
@@ -20,8 +29,7 @@ def plot_head_rot_comparison(dataFrame_1: pd.DataFrame, dataFrame_2: pd.DataFram
     if any(axis in axes_labels_2 for axis in axes_labels_1):
         axes_labels_1 = [axis + '_x' for axis in axes_labels_1]
         axes_labels_2 = [axis + '_y' for axis in axes_labels_2]
-    dataFrame_2['t'] = dataFrame_2['t'] - time_delay
-    data_frame = pd.merge(dataFrame_1, dataFrame_2, on='t')
+    data_frame = merge_on_samples(dataFrame_1, dataFrame_2, round(time_delay / PERIOD))
     plot_ypr(data_frame, [axes_labels_1[0], axes_labels_2[0], axes_labels_1[1], axes_labels_2[1]])
     plt.ylim([-150, 120])
     
@@ -33,9 +41,20 @@ def plot_head_rot_comparison(dataFrame_1: pd.DataFrame, dataFrame_2: pd.DataFram
 
     plt.close()
 
+def merge_on_samples(dataFrame_1: pd.DataFrame, dataFrame_2: pd.DataFrame, lag: int = 0) -> pd.DataFrame:
+    """Samples of dataFrame_1 side by side with the samples of dataFrame_2 lag samples later, on the time axis of
+    dataFrame_1. Same columns as pd.merge on a shifted 't', without joining on floating point times."""
+    start_1, start_2 = max(-lag, 0), max(lag, 0)
+    length = max(0, min(len(dataFrame_1) - start_1, len(dataFrame_2) - start_2))
+    part_1 = dataFrame_1.iloc[start_1:start_1 + length].reset_index(drop=True)
+    part_2 = dataFrame_2.drop(columns='t').iloc[start_2:start_2 + length].reset_index(drop=True)
+    overlap = [column for column in part_2.columns if column in part_1.columns]
+    part_1 = part_1.rename(columns={column: column + '_x' for column in overlap})
+    part_2 = part_2.rename(columns={column: column + '_y' for column in overlap})
+    return pd.concat([part_1, part_2], axis=1)
+
 def create_data_frame(fileName: str, suffix: str = '') -> pd.DataFrame:    
-    quats = read_quaternions(fileName)
-    quats = clean_quaternions(quats)
+    quats = load_quaternions(fileName)
     df = create_quaternions_data_frame(quats)
     euler_df = create_ypr_data_frame(df, suffix)
     euler_df = filter_data_frame(euler_df, suffix)
@@ -50,18 +69,52 @@ def read_quaternions(fileName: str) -> str:
 def clean_quaternions(quats: str) -> list[str]:
     return quats.removesuffix(' _ ').split(' _ ')
 
-def create_quaternions_data_frame(quats: str) -> pd.DataFrame:
-    quatsSplit = [s.split(' ') for s in quats]
+def parse_quaternions(quats: str) -> np.ndarray:
+    return np.fromstring(quats.replace('_', ' '), sep=' ').reshape((-1, 4))
+
+def get_quaternions_cache_file(fileName: str) -> str:
+    return f'{fileName}.{os.path.getsize(fileName)}.npy'
+
+def load_quaternions(fileName: str, cache: bool = True) -> np.ndarray:
+    """(N, 4) quaternions of a HeadRots file, memory-mapped from a .npy cache written next to it on the first call.
+    The cache is named after the size of the file and carries its modification time: it is parsed again when either changes."""
+    if not cache:
+        return parse_quaternions(read_quaternions(fileName))
+    stat = os.stat(fileName)
+    cacheFile = get_quaternions_cache_file(fileName)
+    if os.path.exists(cacheFile) and os.stat(cacheFile).st_mtime_ns == stat.st_mtime_ns:
+        return np.load(cacheFile, mmap_mode='r')
+    quats = parse_quaternions(read_quaternions(fileName))
+    try:
+        write_quaternions_cache(fileName, cacheFile, quats, stat.st_mtime_ns)
+    except OSError:
+        pass
+    return quats
+
+def write_quaternions_cache(fileName: str, cacheFile: str, quats: np.ndarray, mtime_ns: int) -> None:
+    for staleFile in glob.glob(f'{glob.escape(fileName)}.*.npy'):
+        os.remove(staleFile)
+    fd, tempFile = tempfile.mkstemp(dir=os.path.dirname(cacheFile), prefix='.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, quats)
+    os.utime(tempFile, ns=(mtime_ns, mtime_ns))
+    os.replace(tempFile, cacheFile)
+
+def create_quaternions_data_frame(quats: list[str] | np.ndarray) -> pd.DataFrame:
     columns = ['X', 'Y', 'Z', 'W']
+    if isinstance(quats, np.ndarray):
+        return pd.DataFrame(np.array(quats, dtype=float), columns = columns)
+    quatsSplit = [s.split(' ') for s in quats]
     return pd.DataFrame(quatsSplit, columns = columns, dtype = float)
 
 def create_ypr_data_frame(quat_df: pd.DataFrame, suffix: str = '') -> pd.DataFrame:
     rot = Rotation.from_quat(quat_df)
     rot_euler = rot.as_euler('xyz', degrees=True)
-    euler_df = pd.DataFrame(data=rot_euler, columns=[_yaw + suffix, _pitch + suffix, _roll + suffix])
-    period = 0.01
-    t = [x * period for x in range(len(euler_df))]
-    euler_df['t'] = pd.to_numeric(t)
+    return create_euler_data_frame(rot_euler, suffix)
+
+def create_euler_data_frame(euler: np.ndarray, suffix: str = '') -> pd.DataFrame:
+    euler_df = pd.DataFrame(data=np.array(euler), columns=[_yaw + suffix, _pitch + suffix, _roll + suffix])
+    euler_df['t'] = np.arange(len(euler_df)) * PERIOD
     return euler_df
 
 def filter_data_frame(df: pd.DataFrame, suffix: str = '') -> pd.DataFrame:
@@ -81,16 +134,102 @@ def plot_ypr(df: pd.DataFrame, axes: list[str]) -> None:
     ax.set_ylabel("Angle (°)")
     df.rename_axis()
 
-def mean_angular_diff(original: pd.Series, repro: pd.Series) -> float:
+def mean_angular_diff(original: pd.Series, repro: pd.Series, lag: int = 0) -> float:
+    original, repro = align_samples(np.asarray(original), np.asarray(repro), lag)
+    return round(float(np.mean(np.abs(original - repro))), 1)
+
+def mean_angular_diffs(original: pd.DataFrame, repro: pd.DataFrame, lag: int = 0) -> tuple:
+    original, repro = align_samples(original.iloc[:, :2].to_numpy(), repro.iloc[:, :2].to_numpy(), lag)
+    yaw, pitch = np.mean(np.abs(original - repro), axis=0)
+    return (round(float(yaw), 1), round(float(pitch), 1))
+
+def align_samples(original: np.ndarray, repro: np.ndarray, lag: int = 0) -> tuple:
+    """original[n] paired with repro[n + lag], truncated to their common length."""
+    original, repro = original[max(-lag, 0):], repro[max(lag, 0):]
     length = min(len(original), len(repro))
-    original = original[:length]
-    repro = repro[:length]
-    return round((sum(abs(original - repro))) / length, 1)
+    return original[:length], repro[:length]
 
-def mean_angular_diffs(original: pd.DataFrame, repro: pd.DataFrame) -> tuple:
-    yaw = mean_angular_diff(original.iloc[:,0], repro.iloc[:,0])
-    pitch = mean_angular_diff(original.iloc[:,1], repro.iloc[:,1])
-    return (yaw, pitch)
+def estimate_lag(original: pd.DataFrame, repro: pd.DataFrame, max_delay: float = 2.) -> int:
+    """Lag (samples) of repro behind original maximising the FFT cross-correlation of their yaw and pitch."""
+    original = original.iloc[:, :2].to_numpy()
+    repro = repro.iloc[:, :2].to_numpy()
+    original = original - np.mean(original, axis=0)
+    repro = repro - np.mean(repro, axis=0)
+    nfft = scipy.fft.next_fast_len(len(original) + len(repro) - 1, real=True)
+    spectrum = scipy.fft.rfft(repro, nfft, axis=0) * np.conj(scipy.fft.rfft(original, nfft, axis=0))
+    cc = scipy.fft.irfft(np.sum(spectrum, axis=1), nfft)
+    max_lag = round(max_delay / PERIOD)
+    lags = np.concatenate((np.arange(0, min(max_lag, len(repro) - 1) + 1), np.arange(-min(max_lag, len(original) - 1), 0)))
+    return int(lags[np.argmax(cc[lags])])
+
+def banded_dtw(original: np.ndarray, repro: np.ndarray, radius: int) -> tuple:
+    """Dynamic time warping of two (N, d) trajectories with an L1 local cost, restricted to a Sakoe-Chiba band of
+    radius samples around the diagonal joining their ends. Rows are processed one at a time, each vectorized over the
+    band: the horizontal dependency is a running minimum of (cost of entering the row) - (cumulated row cost), so time
+    and memory grow as N * radius. Returns the warping path as a (K, 2) array of (original, repro) indices and its cost."""
+    n, m = len(original), len(repro)
+    slope = (m - 1) / max(n - 1, 1)
+    radius = max(int(radius), int(np.ceil(slope)) + 1)
+    lows = np.clip(np.ceil(np.arange(n) * slope - radius).astype(int), 0, m - 1)
+    highs = np.clip(np.floor(np.arange(n) * slope + radius).astype(int), 0, m - 1)
+    lows[0], highs[-1] = 0, m - 1
+    moves = []  # per row and band column: 0 diagonal, 1 vertical, 2 horizontal step
+    previous, previous_low = None, 0
+    for i in range(n):
+        columns = np.arange(lows[i], highs[i] + 1)
+        cost = np.sum(np.abs(repro[columns] - original[i]), axis=1)
+        entry = np.full(len(columns), np.inf)
+        move = np.full(len(columns), 2, dtype=np.int8)
+        if previous is None:
+            entry[0] = cost[0]
+        else:
+            vertical = get_band_values(previous, previous_low, columns)
+            diagonal = get_band_values(previous, previous_low, columns - 1)
+            move[:] = np.where(vertical < diagonal, 1, 0)
+            entry = cost + np.minimum(vertical, diagonal)
+        cumulated = np.cumsum(cost)
+        best = np.minimum.accumulate(entry - cumulated)
+        row = cumulated + best
+        move[1:][best[1:] < entry[1:] - cumulated[1:]] = 2
+        moves.append(move)
+        previous, previous_low = row, lows[i]
+
+    path = [(n - 1, m - 1)]
+    i, j = n - 1, m - 1
+    while i > 0 or j > 0:
+        move = moves[i][j - lows[i]]
+        i, j = (i - 1, j - 1) if move == 0 else (i - 1, j) if move == 1 else (i, j - 1)
+        path.append((i, j))
+    return np.array(path[::-1]), float(previous[-1])
+
+def get_band_values(row: np.ndarray, low: int, columns: np.ndarray) -> np.ndarray:
+    index = columns - low
+    valid = (index >= 0) & (index < len(row))
+    values = np.full(len(columns), np.inf)
+    values[valid] = row[index[valid]]
+    return values
+
+def dtw_angular_diffs(original: pd.DataFrame, repro: pd.DataFrame, band: float = 1.) -> dict:
+    """Mean yaw and pitch differences along the banded DTW path (band in seconds), and statistics of the warping:
+    length of the path, share of diagonal steps, mean and maximum distance to the diagonal (s), and whether the path
+    reached the edge of the band (in which case the band is too narrow for the take)."""
+    original = original.iloc[:, :2].to_numpy()
+    repro = repro.iloc[:, :2].to_numpy()
+    radius = round(band / PERIOD)
+    path, _ = banded_dtw(original, repro, radius)
+    diff = np.abs(original[path[:, 0]] - repro[path[:, 1]])
+    slope = (len(repro) - 1) / max(len(original) - 1, 1)
+    warp = np.abs(path[:, 1] - path[:, 0] * slope)
+    steps = np.diff(path, axis=0)
+    return {
+        'dtw_Y': round(float(np.mean(diff[:, 0])), 1),
+        'dtw_P': round(float(np.mean(diff[:, 1])), 1),
+        'path_length': len(path),
+        'diagonal_steps': float(np.mean(np.all(steps == 1, axis=1))) if len(steps) else 1.,
+        'mean_warp': float(np.mean(warp)) * PERIOD,
+        'max_warp': float(np.amax(warp)) * PERIOD,
+        'band_reached': bool(np.amax(warp) >= max(radius, np.ceil(slope) + 1) - 1),
+    }
 
 def write_visualization_md_file(sentences: pd.DataFrame) -> None:
     output = '|0|1|2|\n|:---:|:---:|:---:|\n'
@@ -103,32 +242,56 @@ def write_visualization_md_file(sentences: pd.DataFrame) -> None:
     f.close()
     
 
+def get_figure_name(take: pd.Series, figures_folder: str = FIGURES_FOLDER) -> str:
+    return os.path.join(figures_folder, '_'.join(list(map(lambda x: str(x), take.iloc[:7]))))
+
+def evaluate_take(take_id: str, fig_name: str, folder: str = HEADROTS_FOLDER, show_fig: bool = False, save_fig: bool = False, archive = None, align: bool = True, dtw_band: float = None) -> dict:
+    if archive is not None:
+        original = archive.data_frame(take_id, 'original', '_o')
+        repro = archive.data_frame(take_id, 'repro', '_r')
+    else:
+        original = create_data_frame(os.path.join(folder, f'{take_id}.txt'), '_o')
+        repro = create_data_frame(os.path.join(folder, f'{take_id}_1.txt'), '_r')
+    lag = estimate_lag(original, repro) if align else 0
+    if show_fig or save_fig:
+        plot_head_rot_comparison(dataFrame_1 = original, dataFrame_2 = repro, time_delay = lag * PERIOD, show_fig = show_fig, save_fig = save_fig, fig_name = fig_name)
+    d_yaw, d_pitch = mean_angular_diffs(original, repro, lag)
+    metrics = {'d_Y': d_yaw, 'd_P': d_pitch, 'delay': lag * PERIOD}
+    if dtw_band is not None:
+        metrics.update(dtw_angular_diffs(original, repro, dtw_band))
+    return metrics
+
+def init_worker() -> None:
+    matplotlib.use('Agg')
+
+def evaluate_takes(sentences: pd.DataFrame, folder: str = HEADROTS_FOLDER, figures_folder: str = FIGURES_FOLDER, show_fig: bool = False, save_fig: bool = False, workers: int = None, archive = None, align: bool = True, dtw_band: float = None) -> pd.DataFrame:
+    """Mean yaw and pitch differences of every take, computed on a process pool, inserted in the order of sentences
+    as the d_Y and d_P columns. Figures are only drawn when saved or shown; showing them runs the takes in this process.
+    The takes are read from a headrots_archive.HeadRotsArchive instead of the text files when one is given.
+    With align, the reproduction delay of each take is estimated (estimate_lag), compensated and reported in seconds
+    as the delay column. With a dtw_band (s), the dtw_angular_diffs metrics and warping statistics follow."""
+    figure_names = [get_figure_name(sentences.iloc[i], figures_folder) for i in range(len(sentences))]
+    evaluate = partial(evaluate_take, folder = folder, show_fig = show_fig, save_fig = save_fig, archive = archive, align = align, dtw_band = dtw_band)
+    if show_fig or workers == 1:
+        diffs = list(map(evaluate, sentences['ID'], figure_names))
+    else:
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers = workers, initializer = init_worker) as executor:
+            diffs = list(executor.map(evaluate, sentences['ID'], figure_names, chunksize = max(1, len(sentences) // (4 * workers))))
+
+    sentences = sentences.copy()
+    columns = list(diffs[0]) if diffs else ['d_Y', 'd_P', 'delay']
+    for loc, column in enumerate(columns, start = 7):
+        sentences.insert(loc = loc, column = column, value = [diff[column] for diff in diffs])
+    sentences.insert(loc = 7 + len(columns), column = 'fig_n', value = figure_names)
+    return sentences
+
 def main() -> None:
 
     sentences = pd.read_csv(r'utils_manip_directivite/sentences_recording/Phrases.csv')
     sentences = sentences.sort_values(by = ['D','A','M','T','N','Rec_N'])
-    
 
-    yaw_diffs = []
-    pitch_diffs = []
-    figure_names = []
-
-    for i in range(len(sentences)):
-        take = sentences.iloc[i]
-        original_file = os.path.join(HEADROTS_FOLDER, f'{take["ID"]}.txt')
-        repro_file = os.path.join(HEADROTS_FOLDER, f'{take["ID"]}_1.txt')
-        original = create_data_frame(original_file, '_o')
-        repro = create_data_frame(repro_file, '_r')
-        fig_name = rf"C:\Users\labsticc\Documents\Manips\Gauthier\Directivité\Enregistrement_Anechoique\HeadRots_figs\{'_'.join(list(map(lambda x: str(x), take.iloc[:7])))}"
-        plot_head_rot_comparison(dataFrame_1 = original, dataFrame_2 = repro, time_delay = 0, show_fig = False, save_fig = False, fig_name = fig_name)
-        diff_yaw, diff_pitch = mean_angular_diffs(original, repro)
-        yaw_diffs.append(diff_yaw)
-        pitch_diffs.append(diff_pitch)
-        figure_names.append(fig_name)
-
-    sentences.insert(loc = 7, column = 'd_Y', value = yaw_diffs)
-    sentences.insert(loc = 8, column = 'd_P', value = pitch_diffs)
-    sentences.insert(loc = 9, column = 'fig_n', value = figure_names)
+    sentences = evaluate_takes(sentences, show_fig = False, save_fig = False)
     write_visualization_md_file(sentences)
 
 if __name__ == '__main__':
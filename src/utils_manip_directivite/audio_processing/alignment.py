@@ -0,0 +1,98 @@
+import numpy as np
+import soundfile as sf
+from scipy import signal
+from scipy import fft as sp_fft
+
+
+def gcc_phat(y, y0, max_lag=None):
+    """
+    Lag of y relative to y0 (y[n] ~ y0[n - lag]) maximising their
+    generalized cross-correlation with phase transform weighting.
+
+    :param y: mono signal
+    :param y0: mono reference
+    :param max_lag: largest absolute lag searched (samples), unbounded by default
+    :return: lag in samples
+    """
+    nfft = sp_fft.next_fast_len(len(y) + len(y0) - 1, real=True)
+    cross = sp_fft.rfft(y, nfft) * np.conj(sp_fft.rfft(y0, nfft))
+    cross /= np.maximum(np.abs(cross), np.finfo(float).tiny)
+    cc = sp_fft.irfft(cross, nfft)
+
+    # circular correlation: lags 0..len(y)-1 then -(len(y0)-1)..-1
+    max_positive = len(y) - 1 if max_lag is None else min(max_lag, len(y) - 1)
+    max_negative = len(y0) - 1 if max_lag is None else min(max_lag, len(y0) - 1)
+    lags = np.concatenate((np.arange(0, max_positive + 1), np.arange(-max_negative, 0)))
+    return int(lags[np.argmax(np.abs(cc[lags]))])
+
+
+def refine_lag(y, y0, lag, radius):
+    """
+    Lag maximising the full rate cross-correlation of y and y0 within radius
+    samples of a coarse estimate, by direct dot products over the overlap.
+
+    :param y: mono signal
+    :param y0: mono reference
+    :param lag: coarse lag (samples)
+    :param radius: half width of the search (samples)
+    :return: lag in samples
+    """
+    candidates = np.arange(lag - radius, lag + radius + 1)
+    scores = np.zeros(len(candidates))
+    for i, candidate in enumerate(candidates):
+        shifted, reference = shift_pair(y, y0, candidate)
+        n = min(len(shifted), len(reference))
+        if n > 0:
+            scores[i] = abs(np.dot(shifted[:n], reference[:n])) / n
+    return int(candidates[np.argmax(scores)])
+
+
+def estimate_lag(y, y0, fs, max_delay=1., decimation=8, max_duration=30.):
+    """
+    Lag of the pmx signal y relative to the reference y0, estimated with
+    GCC-PHAT on decimated mono folds of the first max_duration seconds, then
+    refined at full rate around the coarse estimate.
+
+    :param y: signal to correct, mono or (samples x channels)
+    :param y0: reference signal, mono or (samples x channels)
+    :param fs:
+    :param max_delay: largest absolute delay searched (s)
+    :param decimation: decimation factor of the coarse estimate (1 for none)
+    :param max_duration: length of the excerpt analysed (s)
+    :return: lag in samples, positive when y is late
+    """
+    n = int(max_duration * fs)
+    y, y0 = (np.mean(x[:n], axis=1) if x.ndim == 2 else x[:n] for x in (y, y0))
+    if decimation > 1:
+        coarse = gcc_phat(signal.resample_poly(y, 1, decimation), signal.resample_poly(y0, 1, decimation),
+                          max_lag=int(max_delay * fs / decimation))
+        return refine_lag(y, y0, coarse * decimation, 2 * decimation)
+    return gcc_phat(y, y0, max_lag=int(max_delay * fs))
+
+
+def estimate_file_lag(pmx_file, ref_file, max_delay=1., decimation=8, max_duration=30., dtype='float64'):
+    """
+    estimate_lag on the first max_duration seconds of two files, which are
+    the only samples read.
+
+    :return: lag in samples, positive when pmx_file is late
+    """
+    fs = sf.info(ref_file).samplerate
+    frames = int(max_duration * fs)
+    y0, _ = sf.read(ref_file, frames=frames, dtype=dtype)
+    y, _ = sf.read(pmx_file, frames=frames, dtype=dtype)
+    return estimate_lag(y, y0, fs, max_delay, decimation, max_duration)
+
+
+def shift_pair(y, y0, lag):
+    """
+    Drop the first samples of the late signal so that y and y0 are aligned.
+
+    :param y:
+    :param y0:
+    :param lag: lag of y relative to y0 (samples)
+    :return: aligned y, y0
+    """
+    if lag > 0:
+        return y[lag:], y0
+    return y, y0[-lag:]
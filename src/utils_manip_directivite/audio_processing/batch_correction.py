@@ -0,0 +1,26 @@
+import argparse
+from utils_manip_directivite.audio_processing.spectruminvert import apply_correction_batch
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Apply one inverse filter to a list of audio files.')
+    parser.add_argument('inv_file', help='inverse filter written by write_inverse_filter')
+    parser.add_argument('files', nargs='+', help='files to correct, written as <file>_corr<suffix>.wav')
+    parser.add_argument('--gain', type=float, default=None, help='linear correction gain')
+    parser.add_argument('--loudness-ref', nargs='+', default=None, help='loudness reference files, one per file to correct')
+    parser.add_argument('--suffix', default='')
+    parser.add_argument('--blocksize', type=int, default=65536)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64', help='processing precision')
+    args = parser.parse_args()
+
+    if args.loudness_ref is not None and len(args.loudness_ref) != len(args.files):
+        parser.error('--loudness-ref needs one reference per file')
+
+    apply_correction_batch(args.files, args.inv_file, correction_gain=args.gain, loudness_ref_files=args.loudness_ref,
+                           suffix=args.suffix, blocksize=args.blocksize, workers=args.workers,
+                           dtype=args.dtype)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,523 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy
+import soundfile as sf
+from scipy import signal
+from utils_manip_directivite.audio_processing import (alignment, convolution, fir_design, loudness_meter,
+                                                      loudness_normalization, spectruminvert)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def synthetic_pair(duration: float, fs: int = 48000, seed: int = 0) -> tuple:
+    """
+    Pink-ish noise reference and a coloured copy of it, standing in for a
+    ref/pmx pair of recordings.
+    """
+    rng = np.random.default_rng(seed)
+    y0 = rng.standard_normal(int(duration * fs))
+    y0 = signal.lfilter([1], [1, -0.95], y0)
+    y0 /= np.amax(np.abs(y0))
+    b, a = signal.iirfilter(2, [300, 3000], btype='bandpass', fs=fs)
+    y = 0.5 * y0 + 0.5 * signal.lfilter(b, a, y0)
+    return y, y0, fs
+
+
+def synthetic_noise(duration: float, fs: int = 48000, channels: int = 1, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return 0.1 * rng.standard_normal((int(duration * fs), channels))
+
+
+def synthetic_sweep(duration: float, fs: int = 48000, channels: int = 1) -> np.ndarray:
+    """Logarithmic sine sweep from 20 Hz to 20 kHz (or Nyquist) on every channel."""
+    t = np.arange(int(duration * fs)) / fs
+    sweep = 0.5 * signal.chirp(t, f0=20, t1=duration, f1=min(20000, 0.45 * fs), method='logarithmic')
+    return np.repeat(sweep[:, np.newaxis], channels, axis=1)
+
+
+def mag_from_spectrograms_loop(sxx, sxx0, t):
+    """Frame-by-frame reference implementation of get_mag_from_spectrograms."""
+    mag = []
+    thre = spectruminvert.get_rms_threshold(sxx0, t)
+    for i in range(len(t)):
+        rms = spectruminvert.get_rms(sxx0[:, i])
+        if rms < thre:
+            continue
+        s_abs0 = spectruminvert.frac_oct_smooth_fd(sxx0[:, i]).flatten()
+        s_abs = spectruminvert.frac_oct_smooth_fd(sxx[:, i]).flatten()
+        if np.all(s_abs > 0) and np.all(s_abs0 > 0):
+            mag.append(20*np.log10(s_abs/s_abs0))
+    return np.mean(np.array(mag), axis=0)
+
+
+def benchmark_mag_corr(duration: float = 60., fs: int = 48000, nperseg: int = 8192) -> dict:
+    y, y0, fs = synthetic_pair(duration, fs)
+    f, t, sxx0 = signal.spectrogram(y0, fs=fs, mode='complex', nperseg=nperseg)
+    sxx0 = np.abs(sxx0) / np.amax(np.abs(sxx0))
+    f, t, sxx = signal.spectrogram(y, fs=fs, mode='complex', nperseg=nperseg)
+    sxx = np.abs(sxx) / np.amax(np.abs(sxx))
+
+    start = time.perf_counter()
+    spectruminvert.get_smoother(len(f))
+    plan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mag_loop = mag_from_spectrograms_loop(sxx, sxx0, t)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mag_batch = spectruminvert.get_mag_from_spectrograms(sxx, sxx0, t)
+    batch_time = time.perf_counter() - start
+
+    return {
+        'frames': len(t),
+        'loop_s': loop_time,
+        'batch_s': batch_time,
+        'plan_s': plan_time,
+        'speedup': loop_time / batch_time,
+        'max_abs_diff_db': float(np.amax(np.abs(mag_loop - mag_batch))),
+    }
+
+
+def benchmark_smoothing(num_bins: int = 4097, frames: int = 256, frac: float = 3) -> dict:
+    rng = np.random.default_rng(0)
+    data = np.abs(rng.standard_normal((frames, num_bins))) + 1e-3
+
+    start = time.perf_counter()
+    smoother = spectruminvert.FractionalOctaveSmoother(num_bins, frac)
+    plan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = spectruminvert.frac_oct_smooth_fd(data, frac)
+    function_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    smoothed = smoother(data)
+    plan_apply_time = time.perf_counter() - start
+
+    return {
+        'frames': frames,
+        'function_s': function_time,
+        'plan_s': plan_time,
+        'apply_s': plan_apply_time,
+        'speedup': function_time / plan_apply_time,
+        'max_rel_diff': float(np.amax(np.abs(smoothed - reference) / np.abs(reference))),
+    }
+
+
+def check_smoother(cases: tuple = ((257, 3), (1025, 1), (4097, 3), (4097, 6), (8193, 24)), frames: int = 3,
+                   rtol: float = 1e-9, rtol_float32: float = 5e-4, seed: int = 0) -> dict:
+    """
+    Compare spectruminvert.FractionalOctaveSmoother with frac_oct_smooth_fd
+    on random spectra, for each (num_bins, frac) of cases and for 2D, 1D,
+    complex and float32 input, and raise RuntimeError if they differ by
+    more than rtol (rtol_float32 for float32 input, smoothed in single
+    precision) of the peak of the reference.
+
+    :return: deviation of each case and input, relative to the peak of the reference
+    """
+    rng = np.random.default_rng(seed)
+    deviations = {}
+    for num_bins, frac in cases:
+        smoother = spectruminvert.FractionalOctaveSmoother(num_bins, frac)
+        magnitude = np.abs(rng.standard_normal((frames, num_bins))) + 1e-3
+        inputs = {
+            '2d': magnitude,
+            '1d': magnitude[0],
+            'complex': magnitude * np.exp(1j * rng.uniform(0, 2 * np.pi, magnitude.shape)),
+            'float32': magnitude.astype(np.float32),
+        }
+        for name, data_fd in inputs.items():
+            reference = spectruminvert.frac_oct_smooth_fd(data_fd, frac)
+            smoothed = smoother(data_fd)
+            if smoothed.shape != reference.shape:
+                raise RuntimeError(f'Smoother output of shape {smoothed.shape} for {num_bins} bins, 1/{frac} octave, '
+                                   f'{name} input, instead of {reference.shape}')
+            deviation = float(np.amax(np.abs(smoothed - reference)) / np.amax(np.abs(reference)))
+            deviations[f'{num_bins}_{frac}_{name}'] = deviation
+            if deviation > (rtol_float32 if name == 'float32' else rtol):
+                raise RuntimeError(f'FractionalOctaveSmoother differs from frac_oct_smooth_fd by {deviation:.2e} '
+                                   f'for {num_bins} bins, 1/{frac} octave, {name} input')
+    return deviations
+
+
+def benchmark_apply_correction(duration: float = 60., channels: int = 2, fs: int = 48000, ntaps: int = 4097,
+                               blocksize: int = 65536) -> dict:
+    """In-memory convolution (former apply_correction) against the block convolution engine."""
+    rng = np.random.default_rng(0)
+    inv = signal.firwin(ntaps, 8000, fs=fs)
+    with tempfile.TemporaryDirectory() as folder:
+        in_file = os.path.join(folder, 'in.wav')
+        sf.write(in_file, 0.1 * rng.standard_normal((int(duration * fs), channels)), fs, subtype='PCM_24')
+
+        start = time.perf_counter()
+        y, fs = sf.read(in_file)
+        sf.write(os.path.join(folder, 'memory.wav'), spectruminvert.convolve_channels(y, inv), fs, subtype='PCM_24')
+        memory_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        convolution.convolve_file(in_file, os.path.join(folder, 'blocks.wav'), inv, blocksize=blocksize)
+        block_time = time.perf_counter() - start
+
+        max_diff = np.amax(np.abs(sf.read(os.path.join(folder, 'memory.wav'))[0] - sf.read(os.path.join(folder, 'blocks.wav'))[0]))
+
+    return {
+        'audio_s': duration,
+        'channels': channels,
+        'memory_s': memory_time,
+        'block_s': block_time,
+        'memory_throughput': duration / memory_time,
+        'block_throughput': duration / block_time,
+        'max_abs_diff': float(max_diff),
+    }
+
+
+def precision_report(duration: float = 30., fs: int = 48000, channels: int = 2, ntaps: int = 4097,
+                     filter_tolerance: float = 0.05, loudness_tolerance: float = 0.01) -> dict:
+    """
+    Deviation of the float32 mode from the float64 one, on a synthetic pair:
+    magnitude correction and inverse filter response (dB), loudness of the
+    corrected file (LU), and peak memory allocated by each mode.
+    """
+    y, y0, fs = synthetic_pair(duration, fs)
+    with tempfile.TemporaryDirectory() as folder:
+        pmx_file, ref_file = os.path.join(folder, 'pmx.wav'), os.path.join(folder, 'ref.wav')
+        sf.write(pmx_file, 0.5 * np.repeat(y[:, np.newaxis], channels, axis=1), fs, subtype='PCM_24')
+        sf.write(ref_file, 0.5 * np.repeat(y0[:, np.newaxis], channels, axis=1), fs, subtype='PCM_24')
+
+        results = {}
+        for dtype in ['float64', 'float32']:
+            tracemalloc.start()
+            mag, f, _ = spectruminvert.get_mag_corr(pmx_file, ref_file, dtype=dtype)
+            analysis_alloc = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            inv = spectruminvert.design_inverse_filter(mag.copy(), f, fs, ntaps)
+            inv_file = os.path.join(folder, f'inv_{dtype}.wav')
+            sf.write(inv_file, inv / np.amax(np.abs(inv)), fs, subtype='PCM_32')
+
+            tracemalloc.start()
+            spectruminvert.apply_correction(pmx_file, inv_file, suffix=dtype, dtype=dtype)
+            correction_alloc = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            corrected = spectruminvert.get_corrected_filename(pmx_file, dtype)
+            results[dtype] = {
+                'mag': mag,
+                'response': 20 * np.log10(np.abs(signal.freqz(inv, worN=f, fs=fs)[1]) + 1e-12),
+                'loudness': loudness_meter.integrated_loudness_file(corrected),
+                'analysis_alloc_mb': analysis_alloc / 2**20,
+                'correction_alloc_mb': correction_alloc / 2**20,
+            }
+
+    double, single = results['float64'], results['float32']
+    band = (f >= 20) & (f <= 20000)
+    report = {
+        'mag_max_dev_db': float(np.amax(np.abs(single['mag'] - double['mag'])[band])),
+        'filter_max_dev_db': float(np.amax(np.abs(single['response'] - double['response'])[band])),
+        'loudness_dev_lu': float(abs(single['loudness'] - double['loudness'])),
+    }
+    for key in ['analysis_alloc_mb', 'correction_alloc_mb']:
+        report[key] = {'float64': double[key], 'float32': single[key]}
+        report[key.replace('alloc_mb', 'saved')] = 1 - single[key] / double[key]
+    report['within_tolerance'] = (report['filter_max_dev_db'] <= filter_tolerance
+                                  and report['loudness_dev_lu'] <= loudness_tolerance)
+    return report
+
+
+def benchmark_fir_design(ntaps_list: tuple = (1025, 4097, 16385, 65537), fs: int = 48000, nperseg: int = 8192,
+                         firls_max_taps: int = 8193) -> list:
+    """
+    Time and accuracy of each FIR design method against the inv_abs target of
+    design_inverse_filter, on a synthetic correction curve. firls is skipped
+    above firls_max_taps.
+    """
+    f = np.fft.rfftfreq(nperseg, 1 / fs)
+    mag = 3 * np.sin(np.log(f + 1))
+    results = []
+    for ntaps in ntaps_list:
+        for method in fir_design.DESIGNS:
+            if method == 'firls' and ntaps > firls_max_taps:
+                continue
+            target = mag.copy()
+            start = time.perf_counter()
+            inv = spectruminvert.design_inverse_filter(target, f, fs, ntaps, method=method)
+            elapsed = time.perf_counter() - start
+            accuracy = fir_design.design_accuracy(inv, 10 ** (-target / 20), f, fs)
+            results.append({'method': method, 'ntaps': ntaps, 'time_s': elapsed, **accuracy})
+    return results
+
+
+def benchmark_partitioned_convolution(ntaps: int = 4097, blocksizes: tuple = (64, 128, 256, 512), fs: int = 48000,
+                                      channels: int = 2, duration: float = 10.) -> list:
+    """
+    Per-block CPU cost of the PartitionedConvolver against the real-time
+    budget of one block, and error of its output, fed from a file block by
+    block, against signal.convolve.
+    """
+    rng = np.random.default_rng(0)
+    h = rng.standard_normal(ntaps) * np.exp(-np.arange(ntaps) / (ntaps / 8))
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        in_file = os.path.join(folder, 'in.wav')
+        sf.write(in_file, synthetic_noise(duration, fs, channels), fs, subtype='FLOAT')
+        x, _ = sf.read(in_file, always_2d=True)
+        expected = np.stack([signal.convolve(x[:, i], h) for i in range(channels)], axis=1)
+
+        for blocksize in blocksizes:
+            output = np.concatenate(list(convolution.convolve_file_partitioned(in_file, h, blocksize)))
+            max_diff = np.amax(np.abs(output[:len(expected)] - expected))
+
+            # process_time is too coarse for a single block: CPU time is averaged
+            # over all blocks, and the wall time of each block gives the worst case
+            convolver = convolution.PartitionedConvolver(h, blocksize, channels)
+            blocks = [x[start:start + blocksize] for start in range(0, len(x) - blocksize + 1, blocksize)]
+            wall = []
+            cpu = time.process_time()
+            for block in blocks:
+                begin = time.perf_counter()
+                convolver.process(block)
+                wall.append(time.perf_counter() - begin)
+            cpu_per_block = (time.process_time() - cpu) / len(blocks)
+
+            budget = blocksize / fs
+            results.append({
+                'blocksize': blocksize,
+                'ntaps': ntaps,
+                'channels': channels,
+                'partitions': convolver.num_partitions,
+                'budget_us': 1e6 * budget,
+                'cpu_per_block_us': 1e6 * cpu_per_block,
+                'wall_p99_us': 1e6 * float(np.percentile(wall, 99)),
+                'wall_max_us': 1e6 * max(wall),
+                'realtime_factor': budget / cpu_per_block,
+                'keeps_up': float(np.percentile(wall, 99)) < budget,
+                'max_abs_diff': float(max_diff),
+            })
+    return results
+
+
+def _case_smoothing(folder: str, num_bins: int, frames: int = 64) -> tuple:
+    data = np.abs(np.random.default_rng(0).standard_normal((frames, num_bins))) + 1e-3
+    return lambda: spectruminvert.frac_oct_smooth_fd(data), 0.
+
+
+def _case_mag_corr(folder: str, duration: float, fs: int, channels: int, streaming: bool = False,
+                   dtype: str = 'float64', multichannel: bool = False) -> tuple:
+    y, y0, fs = synthetic_pair(duration, fs)
+    pmx_file, ref_file = os.path.join(folder, 'pmx.wav'), os.path.join(folder, 'ref.wav')
+    sf.write(pmx_file, np.repeat(y[:, np.newaxis], channels, axis=1), fs, subtype='FLOAT')
+    sf.write(ref_file, np.repeat(y0[:, np.newaxis], channels, axis=1), fs, subtype='FLOAT')
+    spectruminvert.get_smoother(4097)
+    return lambda: spectruminvert.get_mag_corr(pmx_file, ref_file, streaming=streaming, dtype=dtype,
+                                                multichannel=multichannel), duration
+
+
+def _case_alignment(folder: str, duration: float, fs: int, channels: int, lag: int = 480) -> tuple:
+    y, y0, fs = synthetic_pair(duration, fs)
+    pmx_file, ref_file = os.path.join(folder, 'pmx.wav'), os.path.join(folder, 'ref.wav')
+    sf.write(pmx_file, np.repeat(np.concatenate((np.zeros(lag), y))[:, np.newaxis], channels, axis=1), fs, subtype='FLOAT')
+    sf.write(ref_file, np.repeat(y0[:, np.newaxis], channels, axis=1), fs, subtype='FLOAT')
+    return lambda: alignment.estimate_file_lag(pmx_file, ref_file), duration
+
+
+def _case_firls(folder: str, ntaps: int, fs: int = 48000, method: str = 'firls') -> tuple:
+    f = np.fft.rfftfreq(8192, 1 / fs)
+    mag = 3 * np.sin(np.log(f + 1))
+    return lambda: spectruminvert.design_inverse_filter(mag.copy(), f, fs, ntaps, method=method), 0.
+
+
+def _case_apply_correction(folder: str, duration: float, fs: int, channels: int, signal_type: str = 'noise',
+                           dtype: str = 'float64') -> tuple:
+    in_file, inv_file = os.path.join(folder, 'in.wav'), os.path.join(folder, 'inv.wav')
+    y = synthetic_sweep(duration, fs, channels) if signal_type == 'sweep' else synthetic_noise(duration, fs, channels)
+    sf.write(in_file, y, fs, subtype='PCM_24')
+    sf.write(inv_file, signal.firwin(4097, 8000, fs=fs), fs, subtype='PCM_32')
+    return lambda: spectruminvert.apply_correction(in_file, inv_file, dtype=dtype), duration
+
+
+def _case_equalize(folder: str, duration: float, fs: int, channels: int, files: int = 4, dtype: str = 'float64') -> tuple:
+    paths = [os.path.join(folder, f'{i}.wav') for i in range(files)]
+    for i, path in enumerate(paths):
+        sf.write(path, (i + 1) * synthetic_noise(duration, fs, channels, seed=i) / files, fs, subtype='PCM_24')
+    return lambda: loudness_normalization.equalize(paths, dtype), duration * files
+
+
+CASES = {
+    'smoothing': _case_smoothing,
+    'mag_corr': _case_mag_corr,
+    'firls': _case_firls,
+    'alignment': _case_alignment,
+    'apply_correction': _case_apply_correction,
+    'equalize': _case_equalize,
+}
+
+
+def suite_parameters(quick: bool = False) -> list:
+    """(case, parameters) of the benchmark suite, over durations, channel counts and sampling rates."""
+    durations = [10.] if quick else [10., 60.]
+    parameters = [('smoothing', {'num_bins': n}) for n in ([4097] if quick else [1025, 4097, 16385])]
+    parameters += [('firls', {'ntaps': n}) for n in ([4097] if quick else [1025, 4097, 8193])]
+    parameters += [('firls', {'ntaps': n, 'method': method}) for method in ['frequency_sampling', 'minimum_phase']
+                   for n in ([4097, 16385] if quick else [4097, 16385, 65537])]
+    for duration in durations:
+        for channels in [1, 2]:
+            parameters.append(('mag_corr', {'duration': duration, 'fs': 48000, 'channels': channels}))
+            parameters.append(('mag_corr', {'duration': duration, 'fs': 48000, 'channels': channels, 'streaming': True}))
+            parameters.append(('mag_corr', {'duration': duration, 'fs': 48000, 'channels': channels, 'dtype': 'float32'}))
+        parameters.append(('mag_corr', {'duration': duration, 'fs': 48000, 'channels': 2, 'multichannel': True}))
+        parameters.append(('alignment', {'duration': duration, 'fs': 48000, 'channels': 2}))
+        for fs in [48000] if quick else [44100, 48000, 96000]:
+            for channels in [1, 2] if quick else [1, 2, 4]:
+                parameters.append(('apply_correction', {'duration': duration, 'fs': fs, 'channels': channels}))
+        parameters.append(('apply_correction', {'duration': duration, 'fs': 48000, 'channels': 2, 'signal_type': 'sweep'}))
+        parameters.append(('apply_correction', {'duration': duration, 'fs': 48000, 'channels': 2, 'dtype': 'float32'}))
+        parameters.append(('equalize', {'duration': duration, 'fs': 48000, 'channels': 2}))
+    return parameters
+
+
+def case_name(case: str, parameters: dict) -> str:
+    return case + ''.join(f'|{key}={value}' for key, value in sorted(parameters.items()))
+
+
+def run_case(case: str, parameters: dict) -> dict:
+    """
+    Run one benchmark case: wall and CPU time of the measured call, peak
+    memory allocated during it, peak RSS of the process, and throughput in
+    audio seconds per CPU second. Meant to run in a fresh process, so that the
+    peak RSS belongs to this case only.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        run, audio_seconds = CASES[case](folder, **parameters)
+        tracemalloc.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        run()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        peak_alloc = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = {
+        'case': case,
+        'parameters': parameters,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'peak_alloc_mb': peak_alloc / 2**20,
+        'peak_rss_mb': None,
+        'throughput': audio_seconds / cpu if audio_seconds and cpu > 0 else None,
+    }
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['peak_rss_mb'] = max_rss / 2**20 if platform.system() == 'Darwin' else max_rss / 2**10
+    return result
+
+
+def run_suite(quick: bool = False, verbose: bool = True) -> dict:
+    results = {}
+    for case, parameters in suite_parameters(quick):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_case, case, parameters).result()
+        results[case_name(case, parameters)] = result
+        if verbose:
+            print(f"{case_name(case, parameters)}: {result['wall_s']:.3f} s, {result['peak_alloc_mb']:.1f} MB")
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """
+    Cases whose wall time or peak allocation grew by more than tolerance
+    (relative) compared to the baseline.
+
+    :return: list of (case name, metric, baseline value, new value)
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None:
+            continue
+        for metric in ['wall_s', 'peak_alloc_mb']:
+            if result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append((name, metric, reference[metric], result[metric]))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark suite of the audio_processing hot paths, on synthetic signals.')
+    parser.add_argument('--output', default='benchmarks.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--quick', action='store_true', help='smaller grid of durations, channels and rates')
+    parser.add_argument('--precision', action='store_true', help='only report the deviations of the float32 mode')
+    parser.add_argument('--fir-design', action='store_true', help='only report the time and accuracy of the FIR designs')
+    parser.add_argument('--partitioned', action='store_true', help='only report the per-block cost of the low-latency convolver')
+    parser.add_argument('--reference', action='store_true',
+                        help='only compare the smoother, mag_corr and convolution against their reference code paths')
+    parser.add_argument('--check', action='store_true', help='only check that the smoother plan matches frac_oct_smooth_fd')
+    args = parser.parse_args()
+
+    if args.reference:
+        for name, benchmark in [('smoothing', benchmark_smoothing), ('mag_corr', benchmark_mag_corr),
+                                ('apply_correction', benchmark_apply_correction)]:
+            print(name, json.dumps(benchmark()))
+        return
+
+    if args.check:
+        deviations = check_smoother()
+        print(f'Smoother matches frac_oct_smooth_fd on {len(deviations)} cases, '
+              f'largest deviation {max(deviations.values()):.1e} of the peak')
+        return
+
+    if args.partitioned:
+        for result in benchmark_partitioned_convolution():
+            print(f"{result['blocksize']:>4} samples, {result['partitions']:>3} partitions: "
+                  f"{result['cpu_per_block_us']:8.1f} us/block (p99 {result['wall_p99_us']:.1f} us) "
+                  f"for a {result['budget_us']:.0f} us budget, x{result['realtime_factor']:.1f} real time, "
+                  f"error {result['max_abs_diff']:.1e}")
+        return
+
+    if args.fir_design:
+        for result in benchmark_fir_design():
+            print(f"{result['method']:>18} {result['ntaps']:>6} taps: {1e3 * result['time_s']:9.1f} ms, "
+                  f"max {result['max_dev_db']:.4f} dB, rms {result['rms_dev_db']:.4f} dB")
+        return
+
+    if args.precision:
+        report = precision_report()
+        print(json.dumps(report, indent=1))
+        if not report['within_tolerance']:
+            raise SystemExit(1)
+        return
+
+    results = run_suite(args.quick)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, before, after in regressions:
+            print(f'REGRESSION {name}: {metric} {before:.3f} -> {after:.3f}')
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+import queue
+import threading
+import numpy as np
+import soundfile as sf
+from scipy import fft as sp_fft
+
+
+class OverlapAddConvolver:
+    """
+    Block convolution of a multichannel signal with a FIR filter (overlap-add).
+
+    The filter spectrum is computed once for the FFT size matching the block
+    size; every block is then convolved on all channels at once, and the
+    filter tail is carried over to the next block. A (ntaps x channels)
+    filter applies one filter to each channel.
+    """
+
+    def __init__(self, h, blocksize=65536, h_fd=None):
+        """
+
+        :param h: FIR filter, or (ntaps x channels) filters
+        :param blocksize: maximum number of samples per block
+        :param h_fd: precomputed filter spectrum for this block size (see CorrectionFilter)
+        """
+        self.h = np.asarray(h)
+        self.blocksize = blocksize
+        self.nfft = get_nfft(len(h), blocksize)
+        self.h_fd = _spectrum(self.h, self.nfft) if h_fd is None else h_fd
+        self._tail = None
+
+    def process(self, x):
+        """
+        Convolve the next block of the signal.
+
+        :param x: (samples x channels) block, with at most blocksize samples
+        :return: the len(x) next samples of the filtered signal
+        """
+        n = len(x)
+        y = sp_fft.irfft(sp_fft.rfft(x, self.nfft, axis=0) * self.h_fd, self.nfft, axis=0)[:n + len(self.h) - 1]
+        if self._tail is not None:
+            y[:len(self._tail)] += self._tail
+        self._tail = y[n:]
+        return y[:n]
+
+    def flush(self):
+        """
+        Remaining filter tail (len(h) - 1 samples) once the whole signal has been processed.
+        """
+        tail = self._tail
+        self._tail = None
+        return tail
+
+
+class PartitionedConvolver:
+    """
+    Low-latency block convolution with a long FIR filter (uniformly
+    partitioned overlap-save), for live playback.
+
+    The filter is cut into partitions of blocksize taps, each transformed once
+    with an FFT of 2 * blocksize. Every input block is transformed once and
+    pushed into a frequency-domain delay line holding the spectra of the last
+    partitions blocks; the output block is the inverse FFT of the sum of
+    their products with the filter partitions. The latency is one block,
+    whatever the filter length, and the cost per block is fixed.
+    """
+
+    def __init__(self, h, blocksize=256, channels=1, partitions_fd=None):
+        """
+
+        :param h: FIR filter, or (ntaps x channels) filters
+        :param blocksize: number of samples per block (64 to 512 for live use)
+        :param channels: number of channels of the blocks
+        :param partitions_fd: precomputed partition spectra for this block size (see CorrectionFilter)
+        """
+        self.h = np.asarray(h)
+        self.blocksize = blocksize
+        self.channels = channels
+        self.partitions_fd = _partition_spectra(self.h, blocksize) if partitions_fd is None else partitions_fd
+        self.num_partitions = len(self.partitions_fd)
+        self.reset()
+
+    def reset(self):
+        """Clear the input buffer and the delay line."""
+        self._input = np.zeros((2 * self.blocksize, self.channels), dtype=self.h.dtype)
+        # the delay line is stored twice, so that the last num_partitions
+        # spectra are always the contiguous slice [head:head + num_partitions]
+        self._delay_line = np.zeros((2 * self.num_partitions, self.blocksize + 1, self.channels),
+                                    dtype=self.partitions_fd.dtype)
+        self._head = 0
+
+    def process(self, x):
+        """
+        Convolve the next block of the signal.
+
+        :param x: (blocksize,) or (blocksize x channels) block
+        :return: the blocksize next samples of the filtered signal, shaped as x
+        """
+        x = np.asarray(x)
+        n = self.blocksize
+        self._input[:n] = self._input[n:]
+        self._input[n:] = x.reshape((n, -1))
+
+        self._head = (self._head - 1) % self.num_partitions
+        spectrum = sp_fft.rfft(self._input, axis=0)
+        self._delay_line[self._head] = spectrum
+        self._delay_line[self._head + self.num_partitions] = spectrum
+
+        recent = self._delay_line[self._head:self._head + self.num_partitions]
+        partitions_fd = np.broadcast_to(self.partitions_fd, recent.shape)
+        y = sp_fft.irfft(np.einsum('pfc,pfc->fc', recent, partitions_fd), 2 * n, axis=0)[n:]
+        return y.reshape(x.shape)
+
+
+def _spectrum(h, nfft):
+    """(freq x channels) spectrum of a filter, with a single channel for a 1D filter."""
+    return sp_fft.rfft(h.reshape((len(h), -1)), nfft, axis=0)
+
+
+def _partition_spectra(h, blocksize):
+    """(partitions x freq x channels) spectra of the blocksize long partitions of a filter."""
+    h = h.reshape((len(h), -1))
+    num_partitions = -(-len(h) // blocksize)
+    partitions = np.zeros((num_partitions * blocksize, h.shape[1]), dtype=h.dtype)
+    partitions[:len(h)] = h
+    return sp_fft.rfft(partitions.reshape((num_partitions, blocksize, -1)), 2 * blocksize, axis=1)
+
+
+class CorrectionFilter:
+    """
+    FIR filter loaded once, with its spectrum cached for each block size, so
+    that it can be applied to many files without being read or transformed
+    again.
+    """
+
+    def __init__(self, h, fs=None, dtype='float64'):
+        """
+
+        :param h: FIR filter ((ntaps x channels) for one filter per channel), or path of the filter file
+        :param fs: sampling rate (read from the file when h is a path)
+        :param dtype: precision of the filter and of its spectra
+        """
+        if isinstance(h, str):
+            h, fs = sf.read(h, dtype=dtype)
+        self.h = np.asarray(h, dtype=dtype)
+        self.fs = fs
+        self._spectra = {}
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def convolver(self, blocksize=65536):
+        """
+        New OverlapAddConvolver sharing the cached filter spectrum.
+        """
+        with self._lock:
+            if blocksize not in self._spectra:
+                self._spectra[blocksize] = _spectrum(self.h, get_nfft(len(self.h), blocksize))
+            h_fd = self._spectra[blocksize]
+        return OverlapAddConvolver(self.h, blocksize, h_fd=h_fd)
+
+    def partitioned_convolver(self, blocksize=256, channels=1):
+        """
+        New PartitionedConvolver sharing the cached partition spectra.
+        """
+        with self._lock:
+            if blocksize not in self._partitions:
+                self._partitions[blocksize] = _partition_spectra(self.h, blocksize)
+            partitions_fd = self._partitions[blocksize]
+        return PartitionedConvolver(self.h, blocksize, channels, partitions_fd=partitions_fd)
+
+
+def get_nfft(ntaps, blocksize):
+    return sp_fft.next_fast_len(blocksize + ntaps - 1, real=True)
+
+
+def convolve_file(in_file, out_file, h, gain=1., blocksize=65536, subtype='PCM_24', pipelined=False, dtype='float64'):
+    """
+    Filter an audio file block by block and write the result, filter tail
+    included, straight to the output file. Memory depends on the block size
+    and filter length only.
+
+    :param in_file:
+    :param out_file:
+    :param h: FIR filter, or CorrectionFilter to reuse its cached spectrum
+    :param gain: linear gain applied to the output
+    :param blocksize: number of samples read per block
+    :param subtype: output subtype
+    :param pipelined: decode and encode in their own threads, overlapping with the convolution
+    :param dtype: precision of the samples read and of the convolution ('float32' for complex64 spectra)
+    :return: number of samples written
+    """
+    written = 0
+    with sf.SoundFile(in_file) as source:
+        with sf.SoundFile(out_file, 'w', samplerate=source.samplerate, channels=source.channels, subtype=subtype) as destination:
+            blocks = source.blocks(blocksize=blocksize, always_2d=True, dtype=dtype)
+            write = destination.write
+            if pipelined:
+                blocks = _threaded_blocks(blocks)
+                writer = _ThreadedWriter(destination.write)
+                write = writer.write
+            try:
+                for block in convolve_blocks(blocks, h, blocksize, source.channels, dtype):
+                    write(block * gain)
+                    written += len(block)
+            finally:
+                if pipelined:
+                    writer.close()
+    return written
+
+
+def convolve_file_blocks(in_file, h, blocksize=65536, dtype='float64'):
+    """
+    Blocks of an audio file filtered by h, filter tail included, for
+    consumers that do not write the result (e.g. a loudness meter).
+    """
+    with sf.SoundFile(in_file) as source:
+        blocks = source.blocks(blocksize=blocksize, always_2d=True, dtype=dtype)
+        yield from convolve_blocks(blocks, h, blocksize, source.channels, dtype)
+
+
+def convolve_file_partitioned(in_file, h, blocksize=256, dtype='float64'):
+    """
+    Feed an audio file through a PartitionedConvolver, as a live feed would
+    be, and yield its output blocks followed by the filter tail. The last
+    input block is zero-padded to blocksize.
+
+    :param in_file:
+    :param h: FIR filter, or CorrectionFilter
+    :param blocksize:
+    :param dtype: precision of the filter when h is an array
+    """
+    with sf.SoundFile(in_file) as source:
+        if isinstance(h, CorrectionFilter):
+            convolver = h.partitioned_convolver(blocksize, source.channels)
+        else:
+            convolver = PartitionedConvolver(np.asarray(h, dtype=dtype), blocksize, source.channels)
+        _check_channels(convolver.h, source.channels)
+        for block in source.blocks(blocksize=blocksize, always_2d=True, dtype=dtype, fill_value=0):
+            yield convolver.process(block)
+        silence = np.zeros((blocksize, source.channels), dtype=dtype)
+        for _ in range(convolver.num_partitions):
+            yield convolver.process(silence)
+
+
+def convolve_blocks(blocks, h, blocksize, channels, dtype='float64'):
+    """
+    Filter an iterable of (samples x channels) blocks, then yield the filter tail.
+
+    :param blocks:
+    :param h: FIR filter, or CorrectionFilter
+    :param blocksize: maximum number of samples per block
+    :param channels:
+    :param dtype: precision of the filter when h is an array
+    """
+    if isinstance(h, CorrectionFilter):
+        convolver = h.convolver(blocksize)
+    else:
+        convolver = OverlapAddConvolver(np.asarray(h, dtype=dtype), blocksize)
+    _check_channels(convolver.h, channels)
+    for block in blocks:
+        yield convolver.process(block)
+    tail = convolver.flush()
+    if tail is None:
+        tail = np.zeros((len(convolver.h) - 1, channels), dtype=convolver.h.dtype)
+    yield tail
+
+
+def _check_channels(h, channels):
+    if h.ndim == 2 and h.shape[1] not in (1, channels):
+        raise ValueError(f"Filter with {h.shape[1]} channels applied to a signal with {channels} channels")
+
+
+def _threaded_blocks(blocks, maxsize=4):
+    """Iterate over blocks read ahead by a background thread."""
+    buffer = queue.Queue(maxsize=maxsize)
+    done = object()
+
+    def read():
+        try:
+            for block in blocks:
+                buffer.put(block)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(done)
+
+    threading.Thread(target=read, daemon=True).start()
+    while (item := buffer.get()) is not done:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class _ThreadedWriter:
+    """Hand blocks over to a background thread calling write."""
+
+    def __init__(self, write, maxsize=4):
+        self._buffer = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(write,), daemon=True)
+        self._thread.start()
+
+    def _run(self, write):
+        while (block := self._buffer.get()) is not None:
+            if self._error is None:
+                try:
+                    write(block)
+                except Exception as e:
+                    self._error = e
+
+    def write(self, block):
+        if self._error is not None:
+            raise self._error
+        self._buffer.put(block)
+
+    def close(self):
+        self._buffer.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
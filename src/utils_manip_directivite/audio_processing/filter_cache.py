@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+
+class FilterCache:
+    """
+    On-disk cache of the magnitude corrections and inverse filters computed by
+    spectruminvert.write_inverse_filter.
+
+    Entries are .npz files named after a hash of the input audio contents and
+    of the analysis parameters, so that a repeated run with unchanged files and
+    parameters reads its results back instead of computing them. The least
+    recently used entries are evicted once the folder exceeds max_bytes.
+    """
+
+    def __init__(self, folder, max_bytes=256 * 2**20):
+        """
+
+        :param folder: cache folder, created if needed
+        :param max_bytes: maximum total size of the cached entries
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+        self._digests_file = os.path.join(folder, 'digests.json')
+        self._digests = self._read_digests()
+
+    def file_digest(self, path):
+        """
+        SHA-256 of the contents of a file. Digests are remembered (by path,
+        size and modification time) so that unchanged files are not hashed
+        again on the next runs.
+        """
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        known = self._digests.get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['digest']
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(2**20):
+                sha.update(chunk)
+        self._digests[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': sha.hexdigest()}
+        self._write_digests()
+        return sha.hexdigest()
+
+    @staticmethod
+    def key(*parts):
+        """Cache key from JSON-serialisable parts (file digests and parameters)."""
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Arrays stored under key, or None on a miss.
+        """
+        path = self._entry_path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = dict(entry)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        os.utime(path)  # most recently used
+        self.hits += 1
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Store arrays under key, then evict the least recently used entries
+        beyond max_bytes.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, self._entry_path(key))
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.folder, name) for name in os.listdir(self.folder) if name.endswith('.npz')]
+        entries = sorted((os.stat(path).st_mtime_ns, os.path.getsize(path), path) for path in entries)
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        entries = [name for name in os.listdir(self.folder) if name.endswith('.npz')]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(os.path.getsize(os.path.join(self.folder, name)) for name in entries),
+        }
+
+    def _entry_path(self, key):
+        return os.path.join(self.folder, f'{key}.npz')
+
+    def _read_digests(self):
+        try:
+            with open(self._digests_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_digests(self):
+        fd, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._digests, f)
+        os.replace(temp_path, self._digests_file)
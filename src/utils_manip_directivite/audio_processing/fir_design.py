@@ -0,0 +1,114 @@
+import numpy as np
+from scipy import signal
+from scipy import fft as sp_fft
+
+
+def firls_design(gain, f, fs, ntaps):
+    """
+    Linear-phase least-squares design (signal.firls), with every frequency of
+    f as a band edge. The reference design: accurate, but it solves a dense
+    ntaps x ntaps system and becomes slow for long filters.
+
+    :param gain: linear magnitude to reach at each frequency of f
+    :param f: frequencies from 0 to fs/2
+    :param fs:
+    :param ntaps: odd number of taps
+    :return:
+    """
+    return signal.firls(ntaps, f[1:], gain[1:], fs=fs)
+
+
+def frequency_sampling_design(gain, f, fs, ntaps, window='hann'):
+    """
+    Linear-phase design by frequency sampling: the magnitude is interpolated
+    on a dense grid, transformed back with an inverse FFT, then windowed
+    (signal.firwin2).
+
+    :param gain: linear magnitude to reach at each frequency of f
+    :param f: frequencies from 0 to fs/2
+    :param fs:
+    :param ntaps: odd number of taps
+    :param window: window applied to the impulse response
+    :return:
+    """
+    nfreqs = 1 + 2 ** int(np.ceil(np.log2(max(ntaps, len(f)))))
+    return signal.firwin2(ntaps, f, gain, nfreqs=nfreqs, window=window, fs=fs)
+
+
+def minimum_phase_design(gain, f, fs, ntaps, window='hann', oversampling=8):
+    """
+    Minimum-phase design from the magnitude alone (homomorphic method): the
+    real cepstrum of the log magnitude is folded onto positive quefrencies,
+    and the resulting spectrum is transformed back and truncated to ntaps,
+    with a half window fading the tail out. The filter has the same magnitude
+    as the linear-phase designs but almost no latency.
+
+    :param gain: linear magnitude to reach at each frequency of f
+    :param f: frequencies from 0 to fs/2
+    :param fs:
+    :param ntaps:
+    :param window: the second half of this window is applied to the impulse response
+    :param oversampling: size of the FFT grid relative to ntaps, limiting cepstral aliasing
+    :return:
+    """
+    nfft = 2 ** int(np.ceil(np.log2(oversampling * ntaps)))
+    grid = np.fft.rfftfreq(nfft, 1 / fs)
+    log_gain = np.log(np.maximum(np.interp(grid, f, gain), 1e-12))
+
+    cepstrum = sp_fft.irfft(log_gain, nfft)
+    cepstrum[1:nfft // 2] *= 2
+    cepstrum[nfft // 2 + 1:] = 0
+    h = sp_fft.irfft(np.exp(sp_fft.rfft(cepstrum)), nfft)[:ntaps]
+
+    return h * signal.get_window(window, 2 * ntaps, fftbins=False)[ntaps:]
+
+
+DESIGNS = {
+    'firls': firls_design,
+    'frequency_sampling': frequency_sampling_design,
+    'minimum_phase': minimum_phase_design,
+}
+
+
+def design(gain, f, fs, ntaps, method='firls'):
+    """
+    FIR filter approximating the magnitude gain.
+
+    :param gain: linear magnitude to reach at each frequency of f
+    :param f: frequencies from 0 to fs/2
+    :param fs:
+    :param ntaps:
+    :param method: 'firls' (reference), 'frequency_sampling' or 'minimum_phase'
+    :return:
+    """
+    if method not in DESIGNS:
+        raise ValueError(f"Unknown design method '{method}', expected one of {list(DESIGNS)}")
+    return DESIGNS[method](gain, f, fs, ntaps)
+
+
+def response_on_grid(h, f, fs):
+    """
+    Magnitude response of h at the frequencies of f, which must be an
+    rfftfreq grid: one zero-padded FFT rather than a polynomial evaluation
+    per frequency.
+
+    :param h:
+    :param f: np.fft.rfftfreq(nfft, 1/fs) for some even nfft
+    :param fs:
+    :return:
+    """
+    nfft = 2 * (len(f) - 1)
+    oversampling = int(np.ceil(len(h) / nfft))
+    return np.abs(sp_fft.rfft(h, nfft * oversampling))[::oversampling]
+
+
+def design_accuracy(h, gain, f, fs, f_min=20, f_max=16000):
+    """
+    Deviation (dB) of the response of h from the target gain between f_min and f_max.
+
+    :return: dict of the maximum and RMS deviation
+    """
+    band = (f >= f_min) & (f <= f_max)
+    with np.errstate(divide='ignore'):
+        deviation = 20 * np.log10(response_on_grid(h, f, fs)[band] / gain[band])
+    return {'max_dev_db': float(np.amax(np.abs(deviation))), 'rms_dev_db': float(np.sqrt(np.mean(deviation ** 2)))}
@@ -0,0 +1,152 @@
+import numpy as np
+import soundfile as sf
+import pyloudnorm as pyln
+from scipy import signal
+
+CHANNEL_GAINS = [1.0, 1.0, 1.0, 1.41, 1.41]
+ABSOLUTE_GATE = -70.0
+
+
+class StreamingLoudnessMeter:
+    """
+    ITU-R BS.1770-4 integrated loudness measured block by block, matching
+    pyloudnorm.Meter.integrated_loudness.
+
+    The K-weighting filters run with their state carried over from one block
+    to the next, and the mean square of each 400 ms gating block is
+    accumulated as samples arrive. Completed gating blocks go into a
+    histogram of block loudness (resolution dB wide bins, holding the count
+    and summed power of the blocks), from which the absolute and relative
+    gates are applied at the end. Memory therefore does not depend on the
+    signal length.
+    """
+
+    def __init__(self, rate, block_size=0.400, overlap=0.75, resolution=0.001, max_loudness=20.):
+        """
+
+        :param rate: sampling rate (Hz)
+        :param block_size: gating block size (s)
+        :param overlap: overlap of the gating blocks
+        :param resolution: width of the histogram bins (dB)
+        :param max_loudness: upper bound of the histogram (LUFS), louder blocks fall in the last bin
+        """
+        self.rate = rate
+        self.block_size = block_size
+        self.overlap = overlap
+        self.resolution = resolution
+        # same K-weighting coefficients as pyloudnorm
+        self._filters = [(f.b, f.a, f.passband_gain) for f in pyln.Meter(rate)._filters.values()]
+        self._bins = int(np.ceil((max_loudness - ABSOLUTE_GATE) / resolution))
+        self.reset()
+
+    def reset(self):
+        self._zi = None
+        self._samples = 0
+        self._next_block = 0
+        self._open_blocks = {}
+        self._counts = np.zeros(self._bins)
+        self._powers = np.zeros(self._bins)
+
+    def update(self, data):
+        """
+        Feed the next samples of the signal.
+
+        :param data: (samples,) or (samples x channels) block
+        """
+        data = np.asarray(data, dtype=float)
+        if data.ndim == 1:
+            data = data.reshape((-1, 1))
+        if self._zi is None:
+            self._zi = [np.zeros((max(len(a), len(b)) - 1, data.shape[1])) for b, a, _ in self._filters]
+
+        for i, (b, a, gain) in enumerate(self._filters):
+            data, self._zi[i] = signal.lfilter(b, a, data, axis=0, zi=self._zi[i])
+            data *= gain
+
+        gains = np.array(CHANNEL_GAINS[:data.shape[1]])
+        cumulated = np.concatenate(([0.], np.cumsum(np.square(data) @ gains)))
+        start, stop = self._samples, self._samples + len(data)
+
+        while self._block_bounds(self._next_block)[0] < stop:
+            self._open_blocks[self._next_block] = 0.
+            self._next_block += 1
+        for j in self._open_blocks:
+            lower, upper = self._block_bounds(j)
+            lower, upper = max(lower, start) - start, min(upper, stop) - start
+            if upper > lower:
+                self._open_blocks[j] += cumulated[upper] - cumulated[lower]
+        self._samples = stop
+
+        num_blocks = self._num_blocks()
+        for j in [j for j in self._open_blocks if self._block_bounds(j)[1] <= stop and j < num_blocks]:
+            self._add_block(self._counts, self._powers, self._open_blocks.pop(j))
+
+    def loudness(self):
+        """
+        Integrated gated loudness (LUFS) of the samples fed so far.
+        """
+        if self._samples < self.block_size * self.rate:
+            raise ValueError("Audio must have length greater than the block size.")
+
+        counts, powers = self._counts.copy(), self._powers.copy()
+        # blocks cut short by the end of the signal, as pyloudnorm counts them
+        for j in range(self._num_blocks()):
+            if j in self._open_blocks:
+                self._add_block(counts, powers, self._open_blocks[j])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gamma_r = -0.691 + 10.0 * np.log10(np.sum(powers) / np.sum(counts)) - 10.0
+        if np.isnan(gamma_r):
+            return -np.inf
+
+        # bins above the relative gate, and the share of the bin it falls in
+        position = (gamma_r - ABSOLUTE_GATE) / self.resolution
+        weights = np.clip(np.arange(1, self._bins + 1) - position, 0, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            loudness = -0.691 + 10.0 * np.log10(np.sum(powers * weights) / np.sum(counts * weights))
+        return loudness if not np.isnan(loudness) else -np.inf
+
+    def integrated_loudness(self, data, blocksize=65536):
+        """
+        Drop-in for pyloudnorm.Meter.integrated_loudness: measure a whole signal.
+
+        :param data: (samples,) or (samples x channels) signal
+        :param blocksize: number of samples filtered at once
+        :return: LUFS
+        """
+        self.reset()
+        for start in range(0, len(data), blocksize):
+            self.update(data[start:start + blocksize])
+        return self.loudness()
+
+    def _block_bounds(self, j):
+        step = 1.0 - self.overlap
+        return int(self.block_size * (j * step) * self.rate), int(self.block_size * (j * step + 1) * self.rate)
+
+    def _num_blocks(self):
+        duration = self._samples / self.rate
+        if duration < self.block_size:
+            return 0
+        return int(np.round((duration - self.block_size) / (self.block_size * (1.0 - self.overlap)))) + 1
+
+    def _add_block(self, counts, powers, energy):
+        power = energy / (self.block_size * self.rate)
+        with np.errstate(divide='ignore'):
+            block_loudness = -0.691 + 10.0 * np.log10(power)
+        if block_loudness < ABSOLUTE_GATE:
+            return
+        i = min(int((block_loudness - ABSOLUTE_GATE) / self.resolution), self._bins - 1)
+        counts[i] += 1
+        powers[i] += power
+
+
+def integrated_loudness_file(file, blocksize=65536, dtype='float64'):
+    """
+    Integrated loudness (LUFS) of an audio file, read block by block. The
+    filtering and gating run in double precision whatever the dtype read.
+    """
+    with sf.SoundFile(file) as f:
+        meter = StreamingLoudnessMeter(f.samplerate)
+        for block in f.blocks(blocksize=blocksize, dtype=dtype):
+            meter.update(block)
+    return meter.loudness()
@@ -1,24 +1,116 @@
 import soundfile as sf
-import pyloudnorm as pyln
 import os
+import json
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from utils_manip_directivite import AUDIO_FOLDER
+from utils_manip_directivite.audio_processing.loudness_meter import integrated_loudness_file
 
+GROUPS = [('Close', 'Front'), ('Far', 'Front'), ('Close', 'Side'), ('Far', 'Side')]
+LOUDNESS_FILE = '.loudness.json'
 
-def equalize(files: list) -> list:
-    reference, fs = sf.read(files[0])
-    meter = pyln.Meter(fs)
-    target_loudness = meter.integrated_loudness(reference)
+
+def equalize(files: list, dtype: str = 'float64') -> list:
+    target_loudness = measure_loudness(files[0], dtype)
     for file in files[1:]:
-        audio, fs = sf.read(file)
-        loudness = meter.integrated_loudness(audio)
+        loudness = measure_loudness(file, dtype)
         gain = 10**((target_loudness - loudness)/20)
-        audio *= gain
-        sf.write(file = file, data = audio, samplerate = fs)
+        apply_gain(file, gain, dtype=dtype)
+
+
+def measure_loudness(file: str, dtype: str = 'float64') -> float:
+    return integrated_loudness_file(file, dtype=dtype)
+
+
+def apply_gain(file: str, gain: float, blocksize: int = 65536, dtype: str = 'float64') -> None:
+    """Scale a file block by block into a temporary file, which then replaces it."""
+    with sf.SoundFile(file) as source:
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(file), prefix='.', suffix='.tmp')
+        os.close(fd)
+        try:
+            with sf.SoundFile(temp_file, 'w', samplerate=source.samplerate, channels=source.channels,
+                              subtype=source.subtype, format=source.format) as destination:
+                for block in source.blocks(blocksize=blocksize, dtype=dtype):
+                    destination.write(block * gain)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+    os.replace(temp_file, file)
+
+
+def index_groups(folder: str, groups: list = GROUPS) -> dict:
+    """Files of the folder belonging to each group, listing the folder once."""
+    audio_files = [os.path.join(folder, filename) for filename in os.listdir(folder)]
+    return {group: [file for file in audio_files if all(tag in file for tag in group)] for group in groups}
+
+
+def equalize_groups(folder: str = AUDIO_FOLDER, groups: list = GROUPS, workers: int = None, tolerance: float = 0.01,
+                    dtype: str = 'float64') -> dict:
+    """
+    Equalize the loudness of the files of each group to the first file of the group.
+
+    Loudness is measured on a process pool and stored in the folder, along
+    with the size and modification time of each file: files that did not
+    change since the last run are not measured again, and files already
+    within tolerance (LU) of their target are not rewritten. dtype sets the
+    precision the files are read and scaled in.
+
+    :return: gain applied to each rewritten file
+    """
+    file_groups = index_groups(folder, groups)
+    files = list(dict.fromkeys(file for group_files in file_groups.values() for file in group_files))
+
+    loudness_file = os.path.join(folder, LOUDNESS_FILE)
+    known = _read_loudness(loudness_file)
+    loudness = {}
+    to_measure = []
+    for file in files:
+        entry = known.get(os.path.basename(file))
+        if entry is not None and entry['stat'] == _stat(file):
+            loudness[file] = entry['loudness']
+        else:
+            to_measure.append(file)
+
+    gains = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        loudness.update(zip(to_measure, executor.map(measure_loudness, to_measure, repeat(dtype))))
+
+        for group_files in file_groups.values():
+            if not group_files:
+                continue
+            target_loudness = loudness[group_files[0]]
+            for file in group_files[1:]:
+                if abs(target_loudness - loudness[file]) > tolerance:
+                    gains[file] = 10**((target_loudness - loudness[file])/20)
+                    loudness[file] = target_loudness
+
+        list(executor.map(apply_gain, gains.keys(), gains.values(), repeat(65536), repeat(dtype)))
+
+    known.update({os.path.basename(file): {'stat': _stat(file), 'loudness': loudness[file]} for file in files})
+    _write_loudness(loudness_file, known)
+    return gains
+
+
+def _stat(file: str) -> list:
+    stat = os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _read_loudness(loudness_file: str) -> dict:
+    try:
+        with open(loudness_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_loudness(loudness_file: str, loudness: dict) -> None:
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(loudness_file), prefix='.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(loudness, f, indent=1)
+    os.replace(temp_file, loudness_file)
 
 
 if __name__ == '__main__':
-    audio_files = [os.path.join(AUDIO_FOLDER, filename) for filename in os.listdir(AUDIO_FOLDER)]
-    equalize([file for file in audio_files if 'Close' in file and 'Front' in file])
-    equalize([file for file in audio_files if 'Far' in file and 'Front' in file])
-    equalize([file for file in audio_files if 'Close' in file and 'Side' in file])
-    equalize([file for file in audio_files if 'Far' in file and 'Side' in file])
\ No newline at end of file
+    equalize_groups(AUDIO_FOLDER)
@@ -5,11 +5,23 @@ Created on Feb 14 10:58:19 2024
 """
 
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import repeat
 import numpy as np
 import soundfile as sf
-from scipy import signal, interpolate
+from scipy import signal, interpolate, sparse
+from scipy import fft as sp_fft
 import matplotlib.pyplot as plt
-import pyloudnorm as pyln
+from utils_manip_directivite.audio_processing import alignment, convolution, fir_design
+from utils_manip_directivite.audio_processing.convolution import CorrectionFilter, convolve_file, convolve_file_blocks
+from utils_manip_directivite.audio_processing.loudness_meter import StreamingLoudnessMeter, integrated_loudness_file
+
+# largest number of decoded pmx samples (frames x channels) write_inverse_filter keeps for its gain stage:
+# 1 GiB in float64, about 46 min of mono or 23 min of stereo audio at 48 kHz
+AUDIO_BUDGET = 2 ** 27
 
 
 def frac_oct_smooth_fd(data_fd, frac=3):
@@ -82,72 +94,386 @@ def frac_oct_smooth_fd(data_fd, frac=3):
     return data_fd_sm
 
 
-def get_mag_corr(pmx_file, ref_file):
+class FractionalOctaveSmoother:
+    """
+    Precomputed plan of `frac_oct_smooth_fd` for a given number of bins and
+    octave fraction.
+
+    Every step of the smoothing is linear in the (magnitude) spectrum, so the
+    chain is stored once as:
+    - a sparse matrix for the cubic interpolation onto the log-spaced bins,
+    - the spectrum of the Gaussian `filtfilt` kernel, applied by FFT on the
+      edge-padded log spectrum,
+    - a sparse matrix for the linear interpolation back onto the linear bins.
+    Applying the smoother is then two sparse products and one FFT convolution
+    along the last axis.
+
+    Use `get_smoother` to reuse plans across calls.
+    """
+
+    def __init__(self, num_bins, frac=3, chunk_size=512, tol=1e-13):
+        """
+
+        :param num_bins: length of the single-sided spectra to smooth
+        :param frac: fraction of octaves
+        :param chunk_size: number of unit spectra interpolated at once while building the plan
+        :param tol: interpolation weights below this value are dropped from the sparse matrices
+        """
+        self.num_bins = num_bins
+        self.frac = frac
+
+        start_bin, stop_bin = 1, num_bins
+        N = stop_bin
+        spacing = 10 ** (np.log10(stop_bin - start_bin) / N)
+        N_oct = np.log10(2) / (frac * np.log10(spacing))
+        N_oct_even = round(N_oct / 2) * 2
+        log_bins = np.logspace(np.log10(start_bin), np.log10(stop_bin - 1), N)
+        lin_bins = np.arange(0, num_bins)
+
+        # cubic interpolation onto the log-spaced bins, from the response to each unit spectrum
+        fill_value = "extrapolate" if log_bins.max() > lin_bins.max() else np.nan
+        columns = []
+        for start in range(0, num_bins, chunk_size):
+            stop = min(start + chunk_size, num_bins)
+            unit = np.zeros((num_bins, stop - start))
+            unit[np.arange(start, stop), np.arange(stop - start)] = 1
+            response = interpolate.interp1d(lin_bins, unit, "cubic", axis=0, fill_value=fill_value)(log_bins)
+            response[np.abs(response) < tol] = 0
+            columns.append(sparse.csr_array(response))
+        self._to_log = sparse.hstack(columns, format="csr")
+
+        # filtfilt with a symmetric FIR is a zero-phase convolution with the window autocorrelation
+        fd_win = signal.windows.gaussian(N_oct_even * 2, N_oct_even / 2.5)
+        self._pad = fd_win.size
+        kernel = np.convolve(fd_win, fd_win[::-1]) / np.sum(fd_win) ** 2
+        self._nfft = sp_fft.next_fast_len(N + 2 * self._pad + kernel.size - 1, real=True)
+        self._kernel_fd = sp_fft.rfft(kernel, self._nfft)
+        self._offset = 2 * self._pad - 1
+
+        # linear interpolation (with extrapolation) back onto the linear bins
+        upper = np.clip(np.searchsorted(log_bins, lin_bins, side="right"), 1, N - 1)
+        lower = upper - 1
+        weight = (lin_bins - log_bins[lower]) / (log_bins[upper] - log_bins[lower])
+        self._to_lin = sparse.csr_array(
+            (np.concatenate((1 - weight, weight)), (np.concatenate((lin_bins, lin_bins)), np.concatenate((lower, upper)))),
+            shape=(num_bins, N))
+        self._plans = {np.dtype(np.float64): (self._to_log, self._kernel_fd, self._to_lin)}
+
+    def __call__(self, data_fd):
+        """
+        Smooth single-sided spectra along the last axis. float32 spectra are
+        smoothed in single precision, anything else in double precision.
+
+        :param data_fd: single-sided spectra, of length num_bins along the last axis
+        :return: smoothed spectra, as `frac_oct_smooth_fd` would return them
+        """
+        data_fd = np.atleast_2d(data_fd)
+        if np.iscomplexobj(data_fd):
+            data_fd = np.abs(data_fd)
+        shape = data_fd.shape
+        data_fd = data_fd.reshape((-1, self.num_bins))
+        to_log, kernel_fd, to_lin = self._plan(data_fd.dtype)
+
+        data_fd_ip = (to_log @ data_fd.T).T
+        data_fd_ip_extrap = np.concatenate((
+            np.repeat(data_fd_ip[:, :1], self._pad, axis=1),
+            data_fd_ip,
+            np.repeat(data_fd_ip[:, -1:], self._pad, axis=1)), axis=1)
+        data_fd_temp = sp_fft.irfft(sp_fft.rfft(data_fd_ip_extrap, self._nfft, axis=-1) * kernel_fd, self._nfft, axis=-1)
+        data_fd_temp = data_fd_temp[:, self._offset: self._offset + self.num_bins]
+        data_fd_sm = (to_lin @ data_fd_temp.T).T
+
+        return data_fd_sm.reshape(shape)
+
+    def _plan(self, dtype):
+        dtype = np.dtype(np.float32 if dtype == np.float32 else np.float64)
+        if dtype not in self._plans:
+            self._plans[dtype] = (self._to_log.astype(dtype), self._kernel_fd.astype(np.result_type(dtype, np.complex64)),
+                                  self._to_lin.astype(dtype))
+        return self._plans[dtype]
+
+
+def get_smoother(num_bins, frac=3):
+    """
+    Cached `FractionalOctaveSmoother`, built once per (num_bins, frac). The
+    plans are kept in a bounded LRU cache.
+
+    :param num_bins:
+    :param frac:
+    :return:
+    """
+    return _cached_smoother(int(num_bins), float(frac))
+
+
+@lru_cache(maxsize=8)
+def _cached_smoother(num_bins, frac):
+    return FractionalOctaveSmoother(num_bins, frac)
+
+
+def get_mag_corr(pmx_file, ref_file, nperseg=8192, frac=3, streaming=False, frames_per_block=64, dtype='float64',
+                 multichannel=False, align=False):
     """
 
     :param pmx_file:
     :param ref_file:
+    :param nperseg: length of the spectrogram segments
+    :param frac: fraction of octaves of the smoothing
+    :param streaming: read the files block by block instead of loading them whole (see get_mag_corr_streaming)
+    :param frames_per_block: number of spectrogram frames per block in streaming mode
+    :param dtype: 'float32' to read, transform and smooth in single precision (complex64 spectrograms)
+    :param multichannel: one correction per channel (freq x channels) instead of one for the mono fold
+    :param align: time-align the files before the analysis (see alignment.estimate_lag)
+    :return:
+    """
+    if streaming:
+        lag = alignment.estimate_file_lag(pmx_file, ref_file, dtype=dtype) if align else 0
+        return get_mag_corr_streaming(pmx_file, ref_file, nperseg=nperseg, frac=frac, frames_per_block=frames_per_block,
+                                      dtype=dtype, multichannel=multichannel, lag=lag)
+
+    y0, fs = sf.read(ref_file, dtype=dtype)
+    y, fs = sf.read(pmx_file, dtype=dtype)
+    lag = alignment.estimate_lag(y, y0, fs) if align else 0
+    return get_mag_corr_from_audio(y, y0, fs, nperseg=nperseg, frac=frac, multichannel=multichannel, lag=lag)
+
+
+def get_mag_corr_from_audio(y, y0, fs, nperseg=8192, frac=3, multichannel=False, lag=0):
+    """
+    get_mag_corr on already decoded signals.
+
+    :param y: signal to correct
+    :param y0: reference signal
+    :param fs:
+    :param nperseg:
+    :param frac:
+    :param multichannel:
+    :param lag: lag of y relative to y0 (samples), compensated before the analysis
     :return:
     """
-    y0, fs = sf.read(ref_file)
-    y, fs = sf.read(pmx_file)
+    if multichannel:
+        _check_channels(y, y0)
+    y, y0 = alignment.shift_pair(y, y0, lag)
     # ensure that they have the same length
     y = y[:len(y0)]
     y0 = y0[:len(y)]
-    if y.ndim == 2:
-        y = np.mean(y, axis=1)
-    if y0.ndim == 2:
-        y0 = np.mean(y0, axis=1)
-    # compute spectrograms
-    f, t, sxx0 = signal.spectrogram(y0, fs=fs, mode='complex', nperseg=8192)
-    sxx0 = np.abs(sxx0) / np.amax(np.abs(sxx0))
-    f, t, sxx = signal.spectrogram(y, fs=fs, mode='complex', nperseg=8192)
-    sxx = np.abs(sxx) / np.amax(np.abs(sxx))
-
-    mag = []
+    # compute spectrograms (freq x channels x frames)
+    f, t, sxx0 = _magnitude_spectrogram(y0, fs, nperseg, multichannel)
+    sxx0 /= np.amax(sxx0, axis=(0, 2), keepdims=True)
+    f, t, sxx = _magnitude_spectrogram(y, fs, nperseg, multichannel)
+    sxx /= np.amax(sxx, axis=(0, 2), keepdims=True)
+
     nfft = int(2 * (len(f) - 1))
+    mag = get_mag_from_spectrograms(sxx, sxx0, t, frac=frac)
+    freq = np.fft.rfftfreq(nfft, 1/fs)
+
+    return (mag if multichannel else mag[:, 0]), freq, fs
+
+
+def _magnitude_spectrogram(y, fs, nperseg, multichannel):
+    """
+    Magnitude spectrogram (freq x channels x frames) of every channel of y,
+    or of its mono fold (a single channel).
+    """
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+    elif not multichannel:
+        y = np.mean(y, axis=1, keepdims=True)
+    f, t, sxx = signal.spectrogram(y.T, fs=fs, mode='complex', nperseg=nperseg)
+    return f, t, np.abs(sxx).transpose(1, 0, 2)
+
+
+def _check_channels(y, y0):
+    channels, channels0 = (1 if x.ndim == 1 else x.shape[1] for x in (y, y0))
+    if channels != channels0:
+        raise ValueError(f"Multichannel correction needs as many channels in both files ({channels} and {channels0})")
+
+
+def get_mag_corr_streaming(pmx_file, ref_file, nperseg=8192, frac=3, frames_per_block=64, dtype='float64',
+                           multichannel=False, lag=0):
+    """
+    Same correction as get_mag_corr, computed on blocks of both files so that
+    memory depends on nperseg and frames_per_block only, not on the duration.
+
+    The files are read twice:
+    - first pass: mean and standard deviation of the reference frame RMS,
+      which give the noise gate threshold,
+    - second pass: gated frames are smoothed and their dB ratios summed.
+    The normalisation of each spectrogram by its maximum only shifts the
+    ratios by a constant, which is added once both maxima are known.
+
+    :param pmx_file:
+    :param ref_file:
+    :param nperseg: length of the spectrogram segments
+    :param frac: fraction of octaves of the smoothing
+    :param frames_per_block: number of spectrogram frames computed per block
+    :param dtype: precision of the samples read and of the spectrograms
+    :param multichannel: one correction per channel (freq x channels) instead of one for the mono fold
+    :param lag: lag of pmx_file relative to ref_file (samples): the late file is read from that offset
+    :return:
+    """
+    if multichannel and sf.info(pmx_file).channels != sf.info(ref_file).channels:
+        raise ValueError("Multichannel correction needs as many channels in both files")
+    files = [ref_file, pmx_file]
+    starts = [max(-lag, 0), max(lag, 0)]
+
+    count, mean, m2 = 0, 0., 0.
+    for sxx0, in _spectrogram_blocks(files, nperseg, frames_per_block, [0], dtype, multichannel, starts):
+        count, mean, m2 = _update_stats(count, mean, m2, get_rms(sxx0))
+    thre = mean - np.sqrt(m2 / count)  # 'noise gate' threshold, per channel
+
+    smoother = get_smoother(nperseg // 2 + 1, frac)
+    mag_sum, n_frames = 0., 0
+    max0, max1 = 0., 0.
+    for sxx0, sxx in _spectrogram_blocks(files, nperseg, frames_per_block, dtype=dtype, multichannel=multichannel,
+                                         starts=starts):
+        max0 = np.maximum(max0, np.amax(sxx0, axis=(0, 2)))
+        max1 = np.maximum(max1, np.amax(sxx, axis=(0, 2)))
+        block_sum, block_count = _sum_log_ratios(sxx, sxx0, get_rms(sxx0) >= thre[:, np.newaxis], smoother)
+        mag_sum += block_sum
+        n_frames += block_count
+
+    fs = sf.info(ref_file).samplerate
+    mag = (mag_sum / n_frames[:, np.newaxis] + 20*np.log10(max0.astype(float) / max1)[:, np.newaxis]).T
+    freq = np.fft.rfftfreq(nperseg, 1/fs)
+
+    return (mag if multichannel else mag[:, 0]), freq, fs
+
+
+def _spectrogram_blocks(files, nperseg, frames_per_block, files_to_analyse=None, dtype='float64', multichannel=False,
+                        starts=None):
+    """
+    Magnitude spectrograms of the mono fold (or of every channel) of several
+    files, block by block.
+
+    Blocks overlap by nperseg - hop samples, so that each block holds exactly
+    frames_per_block frames of the spectrogram of the whole signal. Files
+    are read from their start offset, and truncated to the shortest one.
+
+    :param files:
+    :param nperseg:
+    :param frames_per_block:
+    :param files_to_analyse: indices of the files to return spectrograms for (all by default)
+    :param dtype: precision of the samples read
+    :param multichannel:
+    :param starts: first sample read in each file (0 by default)
+    :return: generator of lists of (freq x channels x frames) magnitude spectrograms
+    """
+    if files_to_analyse is None:
+        files_to_analyse = range(len(files))
+    if starts is None:
+        starts = [0] * len(files)
+    hop = nperseg - nperseg // 8
+    blocksize = nperseg + (frames_per_block - 1) * hop
+    infos = [sf.info(file) for file in files]
+    frames = min(info.frames - start for info, start in zip(infos, starts))
+    readers = [sf.blocks(files[i], blocksize=blocksize, overlap=nperseg - hop, start=starts[i], frames=frames, dtype=dtype)
+               for i in files_to_analyse]
+
+    for blocks in zip(*readers):
+        if len(blocks[0]) < nperseg:
+            break
+        yield [_magnitude_spectrogram(y, infos[i].samplerate, nperseg, multichannel)[2]
+               for i, y in zip(files_to_analyse, blocks)]
+
+
+def _update_stats(count, mean, m2, values):
+    """Merge a batch of values (along the last axis) into running (count, mean, sum of squared deviations)."""
+    n = values.shape[-1]
+    if n == 0:
+        return count, mean, m2
+    batch_mean = np.mean(values, axis=-1)
+    batch_m2 = np.sum((values - batch_mean[..., np.newaxis]) ** 2, axis=-1)
+    delta = batch_mean - mean
+    total = count + n
+    mean = mean + delta * n / total
+    m2 = m2 + batch_m2 + delta ** 2 * count * n / total
+    return total, mean, m2
+
+
+def get_mag_from_spectrograms(sxx, sxx0, t, frac=3, batch_size=256):
+    """
+    Average smoothed dB ratio between two magnitude spectrograms, computed on
+    batches of frames rather than one frame at a time.
+
+    :param sxx: magnitude spectrogram of the signal to correct (freq x frames, or freq x channels x frames)
+    :param sxx0: magnitude spectrogram of the reference, shaped as sxx
+    :param t: frame times
+    :param frac: fraction of octaves of the smoothing
+    :param batch_size: number of frames gated and smoothed together
+    :return: mean correction in dB for each frequency bin (and channel)
+    """
+    mono = sxx0.ndim == 2
+    if mono:
+        sxx, sxx0 = sxx[:, np.newaxis], sxx0[:, np.newaxis]
     thre = get_rms_threshold(sxx0, t)  # 'noise gate' threshold
-    for i in range(len(t)):
-        rms = get_rms(sxx0[:, i])
-        if rms < thre:  # remove segments with low energy
-            continue
-        s_abs0 = frac_oct_smooth_fd(sxx0[:, i]).flatten()
-        s_abs = frac_oct_smooth_fd(sxx[:, i]).flatten()
-        if np.all(s_abs > 0) and np.all(s_abs0 > 0):
-            mag.append(20*np.log10(s_abs/s_abs0))
+    gate = get_rms(sxx0[..., :len(t)]) >= thre[:, np.newaxis]  # remove segments with low energy
 
-    freq = np.fft.rfftfreq(nfft, 1/fs)
-    mag = np.mean(np.array(mag), axis=0)
+    mag_sum, count = _sum_log_ratios(sxx, sxx0, gate, get_smoother(sxx0.shape[0], frac), batch_size)
+    mag = (mag_sum / count[:, np.newaxis]).T
+    return mag[:, 0] if mono else mag
 
-    return mag, freq, fs
+
+def _sum_log_ratios(sxx, sxx0, gate, smoother, batch_size=256):
+    """
+    Sum over the gated frames of each channel of the smoothed dB ratios.
+
+    Gated frames of all channels are smoothed together, batch_size at a time,
+    and their ratios summed per channel with a (channels x frames) indicator
+    product.
+
+    :param sxx: (freq x channels x frames)
+    :param sxx0: (freq x channels x frames)
+    :param gate: (channels x frames) frames to keep
+    :param smoother:
+    :param batch_size:
+    :return: (channels x freq) sums, and number of frames summed per channel
+    """
+    channels = sxx0.shape[1]
+    channel_idx, frame_idx = np.nonzero(gate)
+    mag_sum = np.zeros((channels, sxx0.shape[0]))
+    count = np.zeros(channels, dtype=int)
+    for start in range(0, len(frame_idx), batch_size):
+        c = channel_idx[start:start + batch_size]
+        idx = frame_idx[start:start + batch_size]
+        s_abs0 = smoother(sxx0[:, c, idx].T)
+        s_abs = smoother(sxx[:, c, idx].T)
+        valid = np.all(s_abs > 0, axis=1) & np.all(s_abs0 > 0, axis=1)
+        ratios = 20*np.log10(s_abs[valid]/s_abs0[valid])
+        if channels == 1:
+            mag_sum[0] += np.sum(ratios, axis=0, dtype=np.float64)
+        else:
+            mag_sum += (c[valid] == np.arange(channels)[:, np.newaxis]).astype(ratios.dtype) @ ratios
+        count += np.bincount(c[valid], minlength=channels)
+    return mag_sum, count
 
 
 def get_rms_threshold(sxx, t):
     """
 
-    :param sxx:
+    :param sxx: (freq x frames), or (freq x channels x frames) for one threshold per channel
     :param t:
     :return:
     """
-    rms = np.zeros(len(t))
-    for i in range(len(t)):
-        rms[i] = get_rms(sxx[:, i])
+    rms = get_rms(sxx[..., :len(t)])
 
-    return np.mean(rms) - np.std(rms)
+    return np.mean(rms, axis=-1) - np.std(rms, axis=-1)
 
 
 def get_rms(rfft):
     """
+    RMS value of single-sided spectra, along the first axis (frequency), so
+    that a whole spectrogram can be processed at once.
 
     :param rfft:
     :return:
     """
     nfft = int(2 * (len(rfft) - 1))
-    rms = np.sqrt((np.sum(np.abs(rfft) ** 2) + np.sum(np.abs(rfft[1:-1]) ** 2)) / nfft)
+    rms = np.sqrt((np.sum(np.abs(rfft) ** 2, axis=0) + np.sum(np.abs(rfft[1:-1]) ** 2, axis=0)) / nfft)
     return rms
 
 
-def write_inverse_filter(pmx_file, ref_file, ntaps=4097, f_min=20, f_max=16000, figure=False, return_gain=False):
+def write_inverse_filter(pmx_file, ref_file, ntaps=4097, f_min=20, f_max=16000, figure=False, return_gain=False,
+                         nperseg=8192, frac=3, streaming=False, workers=None, cache=None, dtype='float64',
+                         method='firls', multichannel=False, align=False, audio_budget=None):
     """
 
     :param pmx_file:
@@ -156,90 +482,302 @@ def write_inverse_filter(pmx_file, ref_file, ntaps=4097, f_min=20, f_max=16000,
     :param f_min:
     :param f_max:
     :param figure:
+    :param nperseg: length of the spectrogram segments
+    :param frac: fraction of octaves of the smoothing
+    :param streaming: analyse the files block by block (see get_mag_corr_streaming)
+    :param workers: number of processes analysing the pairs in list mode, and of threads measuring their gains
+        (all cores by default, 1 for sequential)
+    :param cache: optional filter_cache.FilterCache holding the corrections and filters of previous runs
+    :param dtype: 'float32' to run the analysis and the gain stage in single precision
+    :param method: FIR design method, see fir_design.design ('firls', 'frequency_sampling' or 'minimum_phase')
+    :param multichannel: one filter per channel, written as a multichannel filter file
+    :param align: time-align each pair before the analysis, and print the estimated lags
+    :param audio_budget: largest total number of samples (frames x channels) of the pmx files kept in memory
+        between the analysis and the gain stage (AUDIO_BUDGET by default); above it the gain stage reads them again
     :return:
     """
-    if isinstance(pmx_file, list) and isinstance(ref_file, list):
+    pmx_files = pmx_file if isinstance(pmx_file, list) else [pmx_file]
+    ref_files = ref_file if isinstance(ref_file, list) else [ref_file]
+    if isinstance(pmx_file, list):
+        filename = f'{pmx_file[0][:-4]}_mean_inv_filter.wav'
+    else:
+        filename = f'{pmx_file[:-4]}_inv_filter.wav'
+
+    if cache is not None:
+        digests = [[cache.file_digest(p), cache.file_digest(r)] for p, r in zip(pmx_files, ref_files)]
+        filter_key = cache.key('inverse_filter', digests, ntaps, f_min, f_max, nperseg, frac, dtype, method, multichannel,
+                               align)
+        entry = cache.get(filter_key)
+        if entry is not None and (not return_gain or 'gain' in entry):
+            fs = int(entry['fs'])
+            if figure:
+                _plot_inverse_filter(entry['mag'], entry['freq'], entry['inv'] * entry['peak'], fs)
+            sf.write(filename, entry['inv'], fs, subtype='PCM_32')
+            return (filename, float(entry['gain'])) if return_gain else filename
+
+    audio_budget = AUDIO_BUDGET if audio_budget is None else audio_budget
+    keep_audio = return_gain and not streaming and \
+        sum(info.frames * info.channels for info in map(sf.info, pmx_files)) <= audio_budget
+    parallel = len(pmx_files) > 1 and workers != 1
+
+    with ProcessPoolExecutor(max_workers=workers) if parallel else nullcontext() as executor:
+        map_pairs = executor.map if parallel else map
+
+        pairs = [None] * len(pmx_files)
+        to_analyse = list(range(len(pmx_files)))
+        if cache is not None and not keep_audio:
+            pair_keys = [cache.key('mag_corr', digest, nperseg, frac, dtype, multichannel, align) for digest in digests]
+            for i, key in enumerate(pair_keys):
+                pair_entry = cache.get(key)
+                if pair_entry is not None:
+                    pairs[i] = (pair_entry['mag'], pair_entry['freq'], int(pair_entry['fs']), None, None,
+                                int(pair_entry['lag']))
+            to_analyse = [i for i in to_analyse if pairs[i] is None]
+        analysed = map_pairs(_analyse_pair, [pmx_files[i] for i in to_analyse], [ref_files[i] for i in to_analyse],
+                             repeat(nperseg), repeat(frac), repeat(streaming), repeat(keep_audio), repeat(dtype),
+                             repeat(multichannel), repeat(align))
+        for i, pair in zip(to_analyse, analysed):
+            pairs[i] = pair
+            if cache is not None:
+                cache.put(cache.key('mag_corr', digests[i], nperseg, frac, dtype, multichannel, align),
+                          mag=pair[0], freq=pair[1], fs=pair[2], lag=pair[5])
+        if align:
+            for pmx, (_, _, fs_i, _, _, lag) in zip(pmx_files, pairs):
+                print(f'{pmx}: lag of {lag} samples ({1e3 * lag / fs_i:.2f} ms)')
+
         mag = None
-        for i, p in enumerate(pmx_file):
-            mag_i, f, fs = get_mag_corr(p, ref_file[i])
+        for mag_i, f, fs, _, _, _ in pairs:
             if mag is None:
-                mag = np.zeros(len(mag_i))
-            mag += mag_i / len(pmx_file)
-    else:
-        mag, f, fs = get_mag_corr(pmx_file, ref_file)
+                mag = np.zeros(mag_i.shape)
+            mag += mag_i / len(pmx_files)
+
+        inv = design_inverse_filter(mag, f, fs, ntaps, f_min, f_max, method)
+        if figure:
+            _plot_inverse_filter(mag, f, inv, fs)
+        peak = np.amax(np.abs(inv))
+        inv /= peak
+        sf.write(filename, inv, fs, subtype='PCM_32')
+
+        if not return_gain:
+            if cache is not None:
+                cache.put(filter_key, mag=mag, freq=f, fs=fs, inv=inv, peak=peak)
+            return filename
+
+        if keep_audio:
+            # the audio is already in this process: measure it here rather than send it to the workers again,
+            # on threads, since the FFT convolutions release the GIL, and release each signal once measured
+            inv_written, _ = sf.read(filename, dtype=dtype)
+            with ThreadPoolExecutor(max_workers=workers) as threads:
+                futures = [threads.submit(_pair_gain, y, inv_written, fs, target_loudness)
+                           for _, _, _, y, target_loudness, _ in pairs]
+                pairs.clear()
+                gains = [future.result() for future in futures]
+        else:
+            gains = map_pairs(apply_correction, pmx_files, repeat(filename), repeat(None), ref_files, repeat(True), repeat(''),
+                              repeat(65536), repeat(dtype))
+        gain = 0
+        for g in gains:
+            gain += g / len(pmx_files)
+
+    if cache is not None:
+        cache.put(filter_key, mag=mag, freq=f, fs=fs, inv=inv, peak=peak, gain=gain)
+
+    return filename, gain
+
+
+def _analyse_pair(pmx_file, ref_file, nperseg, frac, streaming, keep_audio, dtype='float64', multichannel=False,
+                  align=False):
+    """
+    Correction of one pmx/ref pair. When keep_audio is set, the decoded pmx
+    signal and the loudness of the reference are returned as well, so that
+    the gain stage does not read the files again.
+
+    :return: mag, freq, fs, pmx signal (or None), reference loudness (or None), lag of the pmx file (samples)
+    """
+    if streaming:
+        lag = alignment.estimate_file_lag(pmx_file, ref_file, dtype=dtype) if align else 0
+        mag, f, fs = get_mag_corr_streaming(pmx_file, ref_file, nperseg=nperseg, frac=frac, dtype=dtype,
+                                            multichannel=multichannel, lag=lag)
+        return mag, f, fs, None, None, lag
+
+    y0, fs = sf.read(ref_file, dtype=dtype)
+    y, fs = sf.read(pmx_file, dtype=dtype)
+    lag = alignment.estimate_lag(y, y0, fs) if align else 0
+    mag, f, fs = get_mag_corr_from_audio(y, y0, fs, nperseg=nperseg, frac=frac, multichannel=multichannel, lag=lag)
+    if not keep_audio:
+        return mag, f, fs, None, None, lag
+
+    return mag, f, fs, y, StreamingLoudnessMeter(fs).integrated_loudness(y0), lag
+
+
+def _pair_gain(y, inv, fs, target_loudness):
+    return get_loudness_gain(convolve_channels(y, inv), target_loudness, fs)
+
+
+def design_inverse_filter(mag, f, fs, ntaps=4097, f_min=20, f_max=16000, method='firls'):
+    """
+    FIR inverting the magnitude correction between f_min and f_max. mag is
+    flattened outside the band in place.
 
+    :param mag: correction in dB, (freq,) or (freq x channels) for one filter per channel
+    :param f: frequencies of mag
+    :param fs:
+    :param ntaps:
+    :param f_min:
+    :param f_max:
+    :param method: 'firls' (least squares, the reference), 'frequency_sampling' or 'minimum_phase'
+    :return: (ntaps,) or (ntaps x channels) filter
+    """
     b_min = int(f_min * len(f) / fs * 2)
     b_max = int(f_max * len(f) / fs * 2)
     mag[:b_min] = mag[b_min]
     mag[b_max:] = mag[b_max]
 
     inv_abs = 10 ** (-mag / 20)
-    inv = signal.firls(ntaps, f[1:], inv_abs[1:], fs=fs)
-
-    if figure:
-        f2 = np.fft.rfftfreq(ntaps, 1 / fs)
-        inv_mag = 20 * np.log10(np.abs(np.fft.rfft(inv)))
-        plt.semilogx(f, -mag)
-        plt.semilogx(f2, inv_mag)
-        plt.ylim([-7, 16])
-        plt.ylabel('Magnitude (dB)')
-        plt.xlabel('Frequency (Hz)')
-        plt.title('Correction filter frequency response')
-        plt.legend(['Target', 'Filter response'])
-        plt.show()
-
-    inv /= np.amax(np.abs(inv))
-    if isinstance(pmx_file, list):
-        filename = f'{pmx_file[0][:-4]}_mean_inv_filter.wav'
-    else:
-        filename = f'{pmx_file[:-4]}_inv_filter.wav'
-    sf.write(filename, inv, fs, subtype='PCM_32')
-
-    if return_gain:
-        if isinstance(pmx_file, list) and isinstance(ref_file, list):
-            gain = 0
-            for i, p in enumerate(pmx_file):
-                g = apply_correction(p, filename, loudness_ref_file=ref_file[i], return_gain=True)
-                gain += g / len(pmx_file)
-        else:
-            gain = apply_correction(pmx_file, filename, loudness_ref_file=ref_file, return_gain=True)
-        return filename, gain
+    if inv_abs.ndim == 2:
+        return np.stack([fir_design.design(gain, f, fs, ntaps, method) for gain in inv_abs.T], axis=1)
+    return fir_design.design(inv_abs, f, fs, ntaps, method)
+
+
+def _plot_inverse_filter(mag, f, inv, fs):
+    f2 = np.fft.rfftfreq(len(inv), 1 / fs)
+    inv_mag = 20 * np.log10(np.abs(np.fft.rfft(inv, axis=0)))
+    plt.semilogx(f, -mag)
+    plt.semilogx(f2, inv_mag)
+    plt.ylim([-7, 16])
+    plt.ylabel('Magnitude (dB)')
+    plt.xlabel('Frequency (Hz)')
+    plt.title('Correction filter frequency response')
+    plt.legend(['Target', 'Filter response'])
+    plt.show()
+
+
+def apply_correction(pmx_file, inv_file, correction_gain=None, loudness_ref_file=None, return_gain=False, suffix='',
+                     blocksize=65536, dtype='float64'):
+    """
+
+    :param pmx_file:
+    :param inv_file:
+    :param loudness_ref_file:
+    :param blocksize: the file is filtered block by block (see convolution.convolve_file)
+    :param dtype: 'float32' to read and convolve in single precision
+    :return:
+    """
+    inv, fs = sf.read(inv_file, dtype=dtype)
+
+    if correction_gain is None:
+        correction_gain = 1
+
+    if loudness_ref_file is not None:
+        gain = get_file_loudness_gain(pmx_file, inv, loudness_ref_file, blocksize, dtype)
+        if return_gain:
+            return gain
+        correction_gain *= gain
 
-    return filename
+    convolve_file(pmx_file, get_corrected_filename(pmx_file, suffix), inv, gain=correction_gain, blocksize=blocksize, dtype=dtype)
 
 
-def apply_correction(pmx_file, inv_file, correction_gain=None, loudness_ref_file=None, return_gain=False, suffix=''):
+def get_file_loudness_gain(pmx_file, inv, loudness_ref_file, blocksize=65536, dtype='float64'):
     """
+    Gain that brings pmx_file, filtered by inv, to the loudness of
+    loudness_ref_file. Both are measured block by block.
 
     :param pmx_file:
-    :param inv_file:
+    :param inv: inverse filter, or a CorrectionFilter
     :param loudness_ref_file:
+    :param blocksize:
+    :param dtype: precision of the samples read
     :return:
     """
-    inv, fs = sf.read(inv_file)
-    y, fs = sf.read(pmx_file)
+    meter = StreamingLoudnessMeter(sf.info(pmx_file).samplerate)
+    for block in convolve_file_blocks(pmx_file, inv, blocksize, dtype):
+        meter.update(block)
+    return 10**((integrated_loudness_file(loudness_ref_file, blocksize, dtype) - meter.loudness())/20)
+
+
+def get_corrected_filename(pmx_file, suffix=''):
+    return f'{pmx_file[:-4]}_corr{suffix}.wav'
+
+
+def apply_correction_batch(files, inv_file, correction_gain=None, loudness_ref_files=None, suffix='', blocksize=65536,
+                           workers=None, verbose=True, dtype='float64'):
+    """
+    apply_correction on a list of files with the same inverse filter.
+
+    The filter is read once and its spectrum computed once per block size.
+    Files are processed on a thread pool, and within each file decoding and
+    encoding run in their own threads, overlapping with the convolution.
+
+    :param files:
+    :param inv_file: path of the inverse filter, or a CorrectionFilter
+    :param correction_gain:
+    :param loudness_ref_files: optional list of loudness references, one per file
+    :param suffix:
+    :param blocksize:
+    :param workers: number of files processed at once (ThreadPoolExecutor default)
+    :param verbose: print the time spent on each file
+    :param dtype: 'float32' to read and convolve in single precision
+    :return: list of (output file, seconds) in the order of files
+    """
+    correction_filter = inv_file if isinstance(inv_file, CorrectionFilter) else CorrectionFilter(inv_file, dtype=dtype)
+    if loudness_ref_files is None:
+        loudness_ref_files = [None] * len(files)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        timings = list(executor.map(_correct_file, files, repeat(correction_filter), repeat(correction_gain), loudness_ref_files,
+                                    repeat(suffix), repeat(blocksize), repeat(dtype)))
+
+    if verbose:
+        for filename, seconds in timings:
+            print(f'{os.path.basename(filename)}: {seconds:.2f} s')
+        print(f'{len(timings)} files, {sum(t for _, t in timings):.2f} s of processing')
+
+    return timings
+
+
+def _correct_file(pmx_file, correction_filter, correction_gain, loudness_ref_file, suffix, blocksize, dtype):
+    start = time.perf_counter()
+    filename = get_corrected_filename(pmx_file, suffix)
+    if correction_gain is None:
+        correction_gain = 1
+
+    if loudness_ref_file is not None:
+        correction_gain *= get_file_loudness_gain(pmx_file, correction_filter, loudness_ref_file, blocksize, dtype)
+    convolve_file(pmx_file, filename, correction_filter, gain=correction_gain, blocksize=blocksize, pipelined=True, dtype=dtype)
+
+    return filename, time.perf_counter() - start
+
+
+def convolve_channels(y, inv):
+    """
+    Convolve each channel of y with the inverse filter.
 
+    :param y: signal, mono or (samples x channels)
+    :param inv: inverse filter, or (ntaps x channels) filters, one per channel
+    :return: (samples x channels) filtered signal
+    """
     if y.ndim == 1:
         y = y.reshape((-1, 1))
+    inv = inv.reshape((len(inv), -1)).astype(y.dtype)
+    convolution._check_channels(inv, y.shape[1])
 
-    s = np.zeros((len(y)+len(inv)-1, y.shape[1]))
+    s = np.zeros((len(y)+len(inv)-1, y.shape[1]), dtype=y.dtype)
     for i in range(y.shape[1]):
-        s[:, i] = signal.convolve(y[:, i], inv)
+        s[:, i] = signal.convolve(y[:, i], inv[:, i if inv.shape[1] > 1 else 0])
+    return s
 
-    if loudness_ref_file is not None:
-        meter = pyln.Meter(fs)
-        y0, fs = sf.read(loudness_ref_file)
-        target_l = meter.integrated_loudness(y0)
-        l = meter.integrated_loudness(s)
-        gain = 10**((target_l - l)/20)
-        s *= gain
-        if return_gain:
-            return gain
 
-    if correction_gain is None:
-        correction_gain = 1
+def get_loudness_gain(s, target_loudness, fs):
+    """
+    Gain that brings s to the target integrated loudness.
 
-    sf.write(f'{pmx_file[:-4]}_corr{suffix}.wav', s * correction_gain, fs, subtype='PCM_24')
+    :param s:
+    :param target_loudness: LUFS
+    :param fs:
+    :return:
+    """
+    l = StreamingLoudnessMeter(fs).integrated_loudness(s)
+    return 10**((target_loudness - l)/20)
 
 
 def main():
@@ -259,13 +797,11 @@ def main():
         pmx_file = folder_path + 'MatchEQ/pmx_file.wav'
         ref_file = folder_path + 'MatchEQ/ref_file.wav'
         inv_file, gain = write_inverse_filter(pmx_file, ref_file, figure=True, return_gain=True)
-        for arceau_file in arceau_files:
-            apply_correction(arceau_file, inv_file, correction_gain=gain)
+        apply_correction_batch(arceau_files, inv_file, correction_gain=gain)
 
     elif method == 2:
         inv_file, gain = write_inverse_filter(pmx_files, ref_files, figure=True, return_gain=True)
-        for pmx_file in pmx_files:
-            apply_correction(pmx_file, inv_file, correction_gain=gain, suffix=str(method))
+        apply_correction_batch(pmx_files, inv_file, correction_gain=gain, suffix=str(method))
 
     elif method == 3:
         for i, pmx_file in enumerate(pmx_files):
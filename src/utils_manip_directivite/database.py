@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+from utils_manip_directivite import DB_PATH
+
+MMAP_SIZE = 256 * 2 ** 20
+CACHED_STATEMENTS = 256
+TIMEOUT = 5.
+
+_local = threading.local()
+
+
+def connect(db_path: str = DB_PATH, read_only: bool = False) -> sqlite3.Connection:
+    """
+    New connection to the database.
+
+    Read-only connections are opened in URI mode=ro, cannot create or modify
+    the database, and read it through a memory map of up to MMAP_SIZE bytes.
+    They never change the journal mode: on a database in WAL mode they do
+    not block the writer (e.g. the listening test app), otherwise they wait
+    up to TIMEOUT for its transactions as any rollback-journal reader.
+
+    Read-write connections switch the database to WAL mode, which persists
+    in the file (see enable_wal).
+
+    :param db_path:
+    :param read_only:
+    :return:
+    """
+    if read_only:
+        uri = f'file:{pathname2url(os.path.abspath(db_path))}?mode=ro'
+        connection = sqlite3.connect(uri, uri=True, timeout=TIMEOUT, cached_statements=CACHED_STATEMENTS)
+        connection.execute('PRAGMA query_only = ON')
+    else:
+        connection = sqlite3.connect(db_path, timeout=TIMEOUT, cached_statements=CACHED_STATEMENTS)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+    connection.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    return connection
+
+
+def enable_wal(db_path: str = DB_PATH) -> str:
+    """
+    Switch the database to WAL mode, which persists in the file, and return
+    the resulting journal mode. This is a one-time step (see
+    db_maintenance), which waits for the other connections' transactions.
+    """
+    connection = sqlite3.connect(db_path, timeout=TIMEOUT)
+    try:
+        return connection.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def reader(db_path: str = DB_PATH) -> sqlite3.Connection:
+    """
+    Read-only connection of the current thread, opened on first use and
+    reused afterwards, so that the statements it has prepared are too.
+    """
+    return _cached(db_path, True)
+
+
+def writer(db_path: str = DB_PATH) -> sqlite3.Connection:
+    """Read-write connection of the current thread, opened on first use and reused afterwards."""
+    return _cached(db_path, False)
+
+
+def _cached(db_path: str, read_only: bool) -> sqlite3.Connection:
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+    key = (os.path.abspath(db_path), read_only)
+    if key not in _local.connections:
+        _local.connections[key] = connect(db_path, read_only)
+    return _local.connections[key]
+
+
+def close(db_path: str = None) -> None:
+    """Close the connections of the current thread to db_path (to any database by default)."""
+    connections = getattr(_local, 'connections', {})
+    for key in [key for key in connections if db_path is None or key[0] == os.path.abspath(db_path)]:
+        connections.pop(key).close()
@@ -1,13 +1,12 @@
-import sqlite3
 import os
-from utils_manip_directivite import AUDIO_FOLDER, DB_PATH
+from utils_manip_directivite import AUDIO_FOLDER, DB_PATH, database
+
+AUDIO_FILES_QUERY = 'SELECT recordings.audio_file FROM recordings'
 
 def get_all_audio_files() -> list:
-    with sqlite3.connect(DB_PATH) as connection:
-        cursor = connection.cursor()
-        query = 'SELECT recordings.audio_file FROM recordings'
-        ratings = cursor.execute(query)
-        return list([rating[0] for rating in ratings])
+    cursor = database.reader(DB_PATH).cursor()
+    ratings = cursor.execute(AUDIO_FILES_QUERY)
+    return list([rating[0] for rating in ratings])
     
 def remove_unused_files(audio_files_to_keep: list) -> int:
     count = 0